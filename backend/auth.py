@@ -0,0 +1,158 @@
+# auth.py
+"""
+Local verification of Clerk session tokens.
+
+Clerk signs session JWTs with RS256 keys published as a JWKS. The key set is
+fetched once at startup and refreshed in the background (and on an unknown
+``kid``, rate-limited), tokens are verified locally with PyJWT in a worker
+thread, and verified claims are memoized until the token's ``exp`` so repeat
+requests with the same token cost a dictionary lookup.
+
+JWKS source: ``CLERK_JWKS_URL`` if set (e.g. the frontend API's
+``/.well-known/jwks.json``), otherwise the Backend API ``/v1/jwks`` endpoint
+authenticated with ``CLERK_SECRET_KEY``. ``iss`` is checked against
+``CLERK_ISSUER`` (the frontend API URL) when it is set.
+"""
+import asyncio
+import os
+import time
+
+import httpx
+import jwt
+
+from cache import TTLCache, make_key
+
+CLERK_API_JWKS_URL = "https://api.clerk.com/v1/jwks"
+JWKS_REFRESH_INTERVAL = float(os.environ.get("CLERK_JWKS_REFRESH", "3600"))
+# Minimum gap between refreshes triggered by tokens with an unknown kid
+JWKS_MIN_REFRESH_GAP = 30.0
+TOKEN_CACHE_SIZE = int(os.environ.get("AUTH_TOKEN_CACHE_SIZE", "10000"))
+# Clock skew tolerated on exp / nbf / iat
+LEEWAY = 5
+
+
+class AuthError(Exception):
+    pass
+
+
+class ClerkJWTVerifier:
+    def __init__(self, jwks_url: str | None = None, secret_key: str | None = None,
+                 authorized_parties: list[str] | None = None, issuer: str | None = None,
+                 refresh_interval: float = JWKS_REFRESH_INTERVAL,
+                 cache_size: int = TOKEN_CACHE_SIZE):
+        self.jwks_url = jwks_url or CLERK_API_JWKS_URL
+        self.secret_key = secret_key
+        self.authorized_parties = authorized_parties or []
+        self.issuer = issuer
+        self.refresh_interval = refresh_interval
+        self.tokens = TTLCache(maxsize=cache_size)
+        self._keys: dict[str, jwt.PyJWK] = {}
+        self._last_refresh = 0.0
+        self._refresh_lock = asyncio.Lock()
+        self._refresh_task: asyncio.Task | None = None
+        self._http: httpx.AsyncClient | None = None
+
+    # --- Lifecycle ---
+    async def start(self):
+        self._http = httpx.AsyncClient(timeout=httpx.Timeout(10.0))
+        try:
+            await self.refresh_keys()
+        except Exception as e:
+            # Not fatal: the next token with an unknown kid retries the fetch
+            print(f"⚠️ Could not fetch Clerk JWKS: {e}")
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+            self._refresh_task = None
+        if self._http:
+            await self._http.aclose()
+            self._http = None
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh_keys()
+            except Exception as e:
+                # Keep serving with the keys we have
+                print(f"⚠️ Clerk JWKS refresh failed: {e}")
+
+    # --- Keys ---
+    async def refresh_keys(self):
+        async with self._refresh_lock:
+            headers = {"Authorization": f"Bearer {self.secret_key}"} if self.secret_key else {}
+            http = self._http or httpx.AsyncClient(timeout=httpx.Timeout(10.0))
+            try:
+                resp = await http.get(self.jwks_url, headers=headers)
+                resp.raise_for_status()
+            finally:
+                if http is not self._http:
+                    await http.aclose()
+            self.set_jwks(resp.json())
+            print(f"🔑 Loaded {len(self._keys)} Clerk signing key(s)")
+
+    def set_jwks(self, jwks: dict):
+        keys = {}
+        for data in jwks.get("keys", []):
+            try:
+                key = jwt.PyJWK(data)
+            except jwt.PyJWKError:
+                continue
+            keys[data.get("kid", "")] = key
+        self._keys = keys
+        self._last_refresh = time.monotonic()
+
+    async def _key_for(self, kid: str) -> jwt.PyJWK:
+        key = self._keys.get(kid)
+        if key is None and time.monotonic() - self._last_refresh > JWKS_MIN_REFRESH_GAP:
+            # Clerk may have rotated its keys since the last refresh
+            try:
+                await self.refresh_keys()
+            except Exception as e:
+                raise AuthError(f"Could not fetch signing keys: {e}")
+            key = self._keys.get(kid)
+        if key is None:
+            raise AuthError(f"Unknown signing key: {kid}")
+        return key
+
+    # --- Verification ---
+    def _decode(self, token: str, key: jwt.PyJWK) -> dict:
+        claims = jwt.decode(
+            token,
+            key=key,
+            algorithms=["RS256"],
+            leeway=LEEWAY,
+            issuer=self.issuer,     # not checked when None
+            options={"require": ["exp", "sub"]},
+        )
+        # Same check as Clerk's authorized_parties option
+        azp = claims.get("azp")
+        if azp and self.authorized_parties and azp not in self.authorized_parties:
+            raise AuthError(f"Invalid authorized party: {azp}")
+        return claims
+
+    async def verify(self, token: str) -> dict:
+        """Returns the token's claims, raising AuthError if it is not valid."""
+        cache_key = make_key(token)
+        claims = self.tokens.get(cache_key)
+        if claims is not None:
+            return claims
+
+        try:
+            kid = jwt.get_unverified_header(token).get("kid", "")
+        except jwt.InvalidTokenError as e:
+            raise AuthError(str(e))
+        key = await self._key_for(kid)
+        try:
+            claims = await asyncio.to_thread(self._decode, token, key)
+        except jwt.InvalidTokenError as e:
+            raise AuthError(str(e))
+
+        # Memoize until the token expires; the cache entry never outlives exp
+        ttl = claims["exp"] - time.time()
+        if ttl > 0:
+            self.tokens.set(cache_key, claims, ttl=ttl)
+        return claims
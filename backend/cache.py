@@ -0,0 +1,248 @@
+# cache.py
+"""
+Small in-process caches shared by the routers.
+
+``LRUCache``  – bounded, least-recently-used eviction.
+``TTLCache``  – bounded LRU whose entries also expire after ``ttl`` seconds.
+``DiskCache`` – TTL cache persisted as one pickle file per key, evicting the
+                least recently used files once ``max_bytes`` is exceeded.
+``FileCache`` – content-addressed raw files (e.g. rendered PDFs) that can be
+                streamed straight from disk, with the same size-bounded eviction.
+
+All of them count hits and misses (``stats()``) and are safe to use from
+worker threads.
+"""
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import BinaryIO
+
+_MISSING = object()
+
+
+def make_key(*parts) -> str:
+    """Stable hash for composite keys such as (query, context id, version)."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(repr(part).encode("utf-8"))
+        digest.update(b"\x1f")
+    return digest.hexdigest()
+
+
+class _Stats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "size": len(self),
+        }
+
+
+class LRUCache(_Stats):
+    def __init__(self, maxsize: int = 1024):
+        super().__init__()
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TTLCache(LRUCache):
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        entry = super().get(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        expires_at, value = entry
+        if expires_at < time.time():
+            with self._lock:
+                self._data.pop(key, None)
+                # Counted as a hit by LRUCache.get; it is really a miss
+                self.hits -= 1
+                self.misses += 1
+            return default
+        return value
+
+    def set(self, key, value, ttl: float | None = None):
+        super().set(key, (time.time() + (self.ttl if ttl is None else ttl), value))
+
+
+class DiskCache(_Stats):
+    def __init__(self, directory: str, ttl: float = 86400, max_bytes: int = 256 * 1024 * 1024):
+        super().__init__()
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, make_key(key) + ".pkl")
+
+    def _entries(self) -> list[os.DirEntry]:
+        return [e for e in os.scandir(self.directory) if e.name.endswith(".pkl")]
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                expires_at, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return default
+        if expires_at < time.time():
+            self.misses += 1
+            self._remove(path)
+            return default
+        # Touch the file so eviction is least-recently-used, not oldest-written
+        os.utime(path)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float | None = None):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((time.time() + (self.ttl if ttl is None else ttl), value), f)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self._remove(self._path(key))
+        return value
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        with self._lock:
+            entries = self._entries()
+            total = sum(e.stat().st_size for e in entries)
+            if total <= self.max_bytes:
+                return
+            for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+                total -= entry.stat().st_size
+                self._remove(entry.path)
+                if total <= self.max_bytes:
+                    break
+
+    def clear(self):
+        for entry in self._entries():
+            self._remove(entry.path)
+
+
+class FileCache(_Stats):
+    def __init__(self, directory: str, suffix: str = "", max_bytes: int = 256 * 1024 * 1024):
+        super().__init__()
+        self.directory = directory
+        self.suffix = suffix
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, make_key(key) + self.suffix)
+
+    def _entries(self) -> list[os.DirEntry]:
+        return [e for e in os.scandir(self.directory) if e.name.endswith(self.suffix) and not e.name.endswith(".tmp")]
+
+    def get_path(self, key) -> str | None:
+        """Path of the cached file, or None on a miss."""
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def open(self, key) -> BinaryIO | None:
+        """
+        The cached file opened for reading, or None on a miss. It is opened
+        under the eviction lock, so the handle stays readable even if the
+        entry is evicted before it has been streamed.
+        """
+        path = self._path(key)
+        with self._lock:
+            try:
+                f = open(path, "rb")
+            except OSError:
+                self.misses += 1
+                return None
+            os.utime(path)
+        self.hits += 1
+        return f
+
+    def put(self, key, data: bytes) -> str:
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._evict(keep=path)
+        return path
+
+    def _evict(self, keep: str):
+        with self._lock:
+            entries = self._entries()
+            total = sum(e.stat().st_size for e in entries)
+            for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+                if total <= self.max_bytes:
+                    break
+                if entry.path == keep:
+                    continue
+                total -= entry.stat().st_size
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
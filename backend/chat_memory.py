@@ -0,0 +1,170 @@
+# chat_memory.py
+"""
+Per-chat conversation memory for the history chatbot.
+
+Each chat id gets its own session holding the most recent turns within a
+token budget; older turns are folded into a rolling summary by the LLM.
+Sessions live in an LRU so idle chats drop out of RAM, and are rebuilt on
+demand from the chat's ``history`` in ``db.chats`` (the summary is stored on
+the same document under ``memory``). Summarisation runs in a background
+task, so a reply never waits for the extra LLM call.
+"""
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from bson import ObjectId
+
+# Summarise(previous summary, overflowing turns) -> new summary
+Summarizer = Callable[[str, list[tuple[str, str]]], Awaitable[str]]
+
+# How many stored messages to read back when rebuilding an evicted session
+RELOAD_MESSAGES = 40
+
+
+def pair_messages(messages: list[dict]):
+    """
+    Yields (question, answer, end) for each user message answered by a model
+    message, where ``end`` is the index just past the answer. Unanswered user
+    messages (e.g. an aborted reply) and stray model messages are skipped.
+    """
+    question = None
+    for i, message in enumerate(messages):
+        text = "".join(p.get("text", "") for p in message.get("parts", []))
+        if message.get("role") == "user":
+            question = text
+        elif question is not None:
+            yield question, text, i + 1
+            question = None
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local estimate (no API call); Urdu averages roughly 3 chars per token."""
+    return len(text) // 3 + 1
+
+
+@dataclass
+class ChatSession:
+    summary: str = ""
+    turns: list[tuple[str, str]] = field(default_factory=list)
+    # Number of stored history messages already folded into the summary (or
+    # dropped because they were older than RELOAD_MESSAGES when reloading)
+    summarized_messages: int = 0
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)  # held while compacting
+
+    def tokens(self) -> int:
+        return estimate_tokens(self.summary) + sum(estimate_tokens(q) + estimate_tokens(a) for q, a in self.turns)
+
+
+class ChatMemoryStore:
+    def __init__(self, summarize: Summarizer, max_tokens: int = 2000, max_sessions: int = 500):
+        self.summarize = summarize
+        self.max_tokens = max_tokens
+        self.max_sessions = max_sessions
+        self.collection = None
+        self._sessions: OrderedDict[str, ChatSession] = OrderedDict()
+        self._tasks: set[asyncio.Task] = set()
+
+    def bind_collection(self, collection):
+        """Persist summaries to / reload sessions from this chats collection."""
+        self.collection = collection
+
+    async def _session(self, chat_id: str) -> ChatSession:
+        session = self._sessions.get(chat_id)
+        if session is None:
+            session = await self._load(chat_id)
+            self._sessions[chat_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(chat_id)
+        return session
+
+    async def _load(self, chat_id: str) -> ChatSession:
+        session = ChatSession()
+        if self.collection is None or not ObjectId.is_valid(chat_id):
+            return session
+        doc = await self.collection.find_one({"_id": ObjectId(chat_id)}, {"memory": 1, "_id": 0})
+        memory = (doc or {}).get("memory") or {}
+        session.summary = memory.get("summary", "")
+        session.summarized_messages = memory.get("summarizedMessages", 0)
+
+        # Only the messages after the summarised prefix, and at most RELOAD_MESSAGES of them
+        doc = await self.collection.find_one(
+            {"_id": ObjectId(chat_id)},
+            {"history": {"$slice": [session.summarized_messages, 10 ** 6]}, "_id": 0},
+        )
+        messages = (doc or {}).get("history", [])
+        skipped = max(0, len(messages) - RELOAD_MESSAGES)
+        session.turns = [(question, answer) for question, answer, _ in pair_messages(messages[skipped:])]
+        session.summarized_messages += skipped
+        return session
+
+    async def load_history(self, chat_id: str | None) -> str:
+        """The summary plus recent turns, formatted for the prompt's chat_history."""
+        if not chat_id:
+            return ""
+        session = await self._session(chat_id)
+        lines = []
+        if session.summary:
+            lines.append(f"خلاصہ: {session.summary}")
+        for question, answer in session.turns:
+            lines.append(f"User: {question}")
+            lines.append(f"AI: {answer}")
+        return "\n".join(lines)
+
+    async def add_turn(self, chat_id: str | None, question: str, answer: str):
+        if not chat_id:
+            return
+        session = await self._session(chat_id)
+        session.turns.append((question, answer))
+        if session.tokens() > self.max_tokens and len(session.turns) >= 2 and not session.lock.locked():
+            task = asyncio.create_task(self._compact(chat_id, session))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _compact(self, chat_id: str, session: ChatSession):
+        """Folds the oldest turns into the summary, keeping at least the latest one."""
+        async with session.lock:
+            while len(session.turns) > 1 and session.tokens() > self.max_tokens:
+                # Turns are only appended meanwhile, so the first `count` stay the same
+                count, tokens = 0, session.tokens()
+                while count < len(session.turns) - 1 and tokens > self.max_tokens // 2:
+                    question, answer = session.turns[count]
+                    tokens -= estimate_tokens(question) + estimate_tokens(answer)
+                    count += 1
+                overflow = session.turns[:count]
+                try:
+                    summary = await self.summarize(session.summary, overflow)
+                    folded = await self._stored_messages(chat_id, session.summarized_messages, count)
+                except Exception as e:
+                    print(f"⚠️ Could not summarise chat {chat_id}: {e}")
+                    return
+                session.summary = summary
+                del session.turns[:count]
+                session.summarized_messages += folded
+                await self._save(chat_id, session)
+
+    async def _stored_messages(self, chat_id: str, start: int, turns: int) -> int:
+        """How many stored history messages after ``start`` hold the next ``turns`` turns."""
+        if self.collection is None or not ObjectId.is_valid(chat_id):
+            return 2 * turns
+        doc = await self.collection.find_one(
+            {"_id": ObjectId(chat_id)},
+            {"history": {"$slice": [start, 10 ** 6]}, "_id": 0},
+        )
+        # Counted with the same pairing as _load, so unanswered messages are included
+        end = 0
+        for n, (_, _, end) in enumerate(pair_messages((doc or {}).get("history", [])), 1):
+            if n == turns:
+                break
+        return end
+
+    async def _save(self, chat_id: str, session: ChatSession):
+        if self.collection is None or not ObjectId.is_valid(chat_id):
+            return
+        await self.collection.update_one(
+            {"_id": ObjectId(chat_id)},
+            {"$set": {"memory": {"summary": session.summary,
+                                 "summarizedMessages": session.summarized_messages}}},
+        )
@@ -0,0 +1,96 @@
+# chat_metadata.py
+"""
+Sidebar metadata for chats, one small document per chat.
+
+This replaces the per-user ``userchats`` document whose ``chats`` array grew
+without bound. Each entry shares its ``_id`` with the chat in ``db.chats``,
+and listing is served newest-first from a compound index on
+(userId, type, createdAt) with an opaque keyset cursor, so a page costs the
+same however many chats a user has.
+"""
+import base64
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import DESCENDING
+
+TITLE_LENGTH = 40
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# (keys, options) pairs, shared with migrate_userchats.py
+INDEXES = [
+    ([("userId", 1), ("type", 1), ("createdAt", DESCENDING), ("_id", DESCENDING)], {"name": "user_type_created"}),
+    ([("userId", 1), ("createdAt", DESCENDING), ("_id", DESCENDING)], {"name": "user_created"}),
+]
+
+LIST_PROJECTION = {"title": 1, "type": 1, "createdAt": 1}
+
+# Mongo hands back naive UTC datetimes
+EPOCH = datetime(1970, 1, 1)
+MILLISECOND = timedelta(milliseconds=1)
+
+
+def metadata_doc(chat_id: ObjectId, user_id: str, chat_type: str, text: str,
+                 created_at: datetime) -> dict:
+    return {
+        "_id": chat_id,
+        "userId": user_id,
+        "type": chat_type,
+        "title": text[:TITLE_LENGTH],
+        "createdAt": created_at,
+    }
+
+
+def encode_cursor(doc: dict) -> str:
+    created_ms = (doc["createdAt"] - EPOCH) // MILLISECOND
+    raw = f"{created_ms}:{doc['_id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, ObjectId]:
+    """Raises ValueError for anything that was not produced by encode_cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_ms, chat_id = raw.split(":", 1)
+        return EPOCH + int(created_ms) * MILLISECOND, ObjectId(chat_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+class ChatMetadataStore:
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        for keys, options in INDEXES:
+            await self.collection.create_index(keys, **options)
+
+    async def add(self, chat_id: ObjectId, user_id: str, chat_type: str, text: str,
+                  created_at: datetime):
+        await self.collection.insert_one(metadata_doc(chat_id, user_id, chat_type, text, created_at))
+
+    async def list(self, user_id: str, chat_type: str | None = None,
+                   limit: int = DEFAULT_PAGE_SIZE, cursor: str | None = None) -> tuple[list[dict], str | None]:
+        """One page of chats, newest first, plus the cursor of the next page (None at the end)."""
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        query: dict = {"userId": user_id}
+        if chat_type:
+            query["type"] = chat_type
+        if cursor:
+            created_at, chat_id = decode_cursor(cursor)
+            # createdAt is stored with millisecond precision, so this keyset is exact
+            query["$or"] = [
+                {"createdAt": {"$lt": created_at}},
+                {"createdAt": created_at, "_id": {"$lt": chat_id}},
+            ]
+
+        # Fetch one extra document to know whether another page exists
+        docs = await (
+            self.collection.find(query, LIST_PROJECTION)
+            .sort([("createdAt", DESCENDING), ("_id", DESCENDING)])
+            .limit(limit + 1)
+            .to_list(length=limit + 1)
+        )
+        next_cursor = encode_cursor(docs[limit - 1]) if len(docs) > limit else None
+        return docs[:limit], next_cursor
@@ -4,11 +4,17 @@ from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from langchain.prompts import PromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.memory import ConversationBufferMemory
 from duckduckgo_search import DDGS
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
-import requests
+from streaming import sse_event, sse_response, stream_llm
+from cache import DiskCache
+from chat_memory import ChatMemoryStore
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+import asyncio
+import httpx
 import random
 import time
 import os
@@ -19,20 +25,46 @@ load_dotenv()
 router = APIRouter()
 
 # --- LangChain Setup ---
-# Memory is managed by the caller (main.py) and passed in the request
-memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True) # REMOVED
-
 # Initialize LLM
 # Ensure GOOGLE_API_KEY is set in your environment or .env file
 try:
     llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0.7)
-    # memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
 
 except Exception as e:
     print(f"Error initializing Google Generative AI model: {e}")
     # You might want to raise an exception or handle this more gracefully
     # depending on your application's startup requirements.
 
+# --- Conversation Memory ---
+summary_template = PromptTemplate(
+    input_variables=["summary", "turns"],
+    template="""
+درج ذیل گفتگو کا مختصر خلاصہ اردو میں لکھیں۔ اہم افراد، مقامات، ادوار اور زیر بحث موضوعات ضرور شامل کریں۔
+
+پچھلا خلاصہ:
+{summary}
+
+نئی گفتگو:
+{turns}
+
+خلاصہ:
+"""
+)
+
+
+async def summarize_turns(summary: str, turns: list[tuple[str, str]]) -> str:
+    formatted_turns = "\n".join(f"User: {q}\nAI: {a}" for q, a in turns)
+    response = await llm.ainvoke(summary_template.format(summary=summary, turns=formatted_turns))
+    return response.content
+
+
+# One bounded session per chat id; main.py binds db.chats for persistence
+memory = ChatMemoryStore(
+    summarize_turns,
+    max_tokens=int(os.getenv("HISTORY_MEMORY_TOKENS", "2000")),
+    max_sessions=int(os.getenv("HISTORY_MEMORY_SESSIONS", "500")),
+)
+
 # Define the prompt template (same as before)
 prompt_template = PromptTemplate(
     input_variables=["question", "context", "websearch", "chat_history"],
@@ -73,36 +105,149 @@ USER_AGENTS = [
     "Mozilla/5.0 (iPhone; CPU iPhone OS 15_0 like Mac OS X)",
 ]
 
-def search_web(query, top_k=3):
-    results = []
+# Whole search (DuckDuckGo + page fetches) must finish within this budget;
+# whatever pages are ready by then are used, the rest are dropped.
+SEARCH_DEADLINE = float(os.getenv("HISTORY_SEARCH_DEADLINE", "6"))
+PAGE_TIMEOUT = httpx.Timeout(5.0, connect=3.0)
+MAX_PAGE_BYTES = 512 * 1024
+# Politeness: one request at a time per host, spaced at least this far apart
+PER_HOST_CONCURRENCY = 1
+HOST_MIN_INTERVAL = 1.0
+
+# Extracted page text is cached on disk per URL. Entries are served without
+# any network call for PAGE_CACHE_TTL, then revalidated with ETag /
+# Last-Modified; they are kept for PAGE_CACHE_RETENTION so a 304 can reuse them.
+PAGE_CACHE_TTL = float(os.getenv("PAGE_CACHE_TTL", str(24 * 3600)))
+PAGE_CACHE_RETENTION = 30 * 24 * 3600
+page_cache = DiskCache("cache/web_pages", ttl=PAGE_CACHE_RETENTION,
+                       max_bytes=int(os.getenv("PAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))))
+page_cache_metrics = {"hits": 0, "revalidated": 0, "misses": 0}
+
+# BeautifulSoup parsing is CPU-bound, so it runs here instead of on the loop
+parse_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="html-parse")
+
+_page_client: httpx.AsyncClient | None = None
+_host_semaphores: dict[str, asyncio.Semaphore] = {}
+_host_next_request: dict[str, float] = {}
+
+
+def get_page_client() -> httpx.AsyncClient:
+    global _page_client
+    if _page_client is None or _page_client.is_closed:
+        _page_client = httpx.AsyncClient(timeout=PAGE_TIMEOUT, follow_redirects=True,
+                                         limits=httpx.Limits(max_connections=20))
+    return _page_client
+
+
+@asynccontextmanager
+async def polite_slot(host: str):
+    semaphore = _host_semaphores.setdefault(host, asyncio.Semaphore(PER_HOST_CONCURRENCY))
+    async with semaphore:
+        loop = asyncio.get_running_loop()
+        wait = _host_next_request.get(host, 0.0) - loop.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        _host_next_request[host] = loop.time() + HOST_MIN_INTERVAL
+        yield
+
+
+def ddg_search(query, top_k):
+    with DDGS() as ddgs:
+        return [r["href"] for r in ddgs.text(query, max_results=top_k)]
+
+
+async def search_web(query, top_k=3, deadline=SEARCH_DEADLINE):
+    """
+    Looks the question up on DuckDuckGo and fetches the top pages concurrently.
+    Returns whatever text was extracted before ``deadline`` seconds elapsed.
+    """
+    loop = asyncio.get_running_loop()
+    budget_end = loop.time() + deadline
     try:
-        # Use max_results parameter as before
-        with DDGS() as ddgs:
-             for r in ddgs.text(query, max_results=top_k):
-                headers = {"User-Agent": random.choice(USER_AGENTS)}
-                # Pass headers to extraction function
-                snippet = extract_text_from_url(r["href"], headers=headers)
-                results.append(snippet)
-                # Add sleep to be polite to websites and avoid rate limits
-                time.sleep(random.uniform(1.2, 2.5))
+        urls = await asyncio.wait_for(asyncio.to_thread(ddg_search, query, top_k), timeout=deadline)
     except Exception as e:
-        results.append(f"❌ Web search failed: {e}")
+        return f"❌ Web search failed: {e}"
+
+    tasks = [
+        asyncio.create_task(extract_text_from_url(url, headers={"User-Agent": random.choice(USER_AGENTS)}))
+        for url in urls
+    ]
+    if not tasks:
+        return ""
+    done, pending = await asyncio.wait(tasks, timeout=max(0.0, budget_end - loop.time()))
+    for task in pending:
+        task.cancel()
+    if pending:
+        print(f"⏱️ Web search budget spent, using {len(done)}/{len(tasks)} pages")
+
+    # Keep search-rank order for the pages that made it
+    results = [task.result() for task in tasks if task in done and not task.exception()]
     return "\n\n".join(results)
 
-def extract_text_from_url(url, headers):
+
+async def fetch_page(url, headers) -> tuple[httpx.Response, str | None]:
+    """
+    Streams the page body, stopping after MAX_PAGE_BYTES. Returns the response
+    and its decoded text (None on 304 Not Modified).
+    """
+    async with polite_slot(urlparse(url).netloc):
+        async with get_page_client().stream("GET", url, headers=headers) as res:
+            if res.status_code == 304:
+                return res, None
+            res.raise_for_status() # Raise an exception for bad status codes
+            body = bytearray()
+            async for chunk in res.aiter_bytes():
+                body.extend(chunk)
+                if len(body) >= MAX_PAGE_BYTES:
+                    break
+            return res, bytes(body[:MAX_PAGE_BYTES]).decode(res.encoding or "utf-8", errors="replace")
+
+
+def extract_text_from_html(html):
+    soup = BeautifulSoup(html, "html.parser")
+    for tag in soup(["script", "style", "noscript"]):
+        tag.decompose() # Remove script, style, noscript tags
+    # Extract text from paragraph tags, stripping whitespace
+    paragraphs = soup.find_all("p")
+    if not paragraphs: # If no paragraphs found, try body text
+         return soup.body.get_text(strip=True) if soup.body else "No readable text found."
+    return "\n".join(p.get_text(strip=True) for p in paragraphs)
+
+
+async def extract_text_from_url(url, headers):
+    # DiskCache unpickles and scans its directory: keep that off the event loop
+    cached = await asyncio.to_thread(page_cache.get, url)
+    if cached and cached["fresh_until"] > time.time():
+        # Fresh hit: no network, no parsing
+        page_cache_metrics["hits"] += 1
+        return cached["text"]
+
+    headers = dict(headers)
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
     try:
-        # Use headers in the request
-        res = requests.get(url, headers=headers, timeout=10)
-        res.raise_for_status() # Raise an exception for bad status codes
-        soup = BeautifulSoup(res.text, "html.parser")
-        for tag in soup(["script", "style", "noscript"]):
-            tag.decompose() # Remove script, style, noscript tags
-        # Extract text from paragraph tags, stripping whitespace
-        paragraphs = soup.find_all("p")
-        if not paragraphs: # If no paragraphs found, try body text
-             return soup.body.get_text(strip=True) if soup.body else "No readable text found."
-        return "\n".join(p.get_text(strip=True) for p in paragraphs)
-    except requests.exceptions.RequestException as e:
+        res, html = await fetch_page(url, headers)
+        if res.status_code == 304 and cached:
+            page_cache_metrics["revalidated"] += 1
+            cached["fresh_until"] = time.time() + PAGE_CACHE_TTL
+            await asyncio.to_thread(page_cache.set, url, cached)
+            return cached["text"]
+
+        page_cache_metrics["misses"] += 1
+        loop = asyncio.get_running_loop()
+        text = await loop.run_in_executor(parse_pool, extract_text_from_html, html)
+        await asyncio.to_thread(page_cache.set, url, {
+            "text": text,
+            "etag": res.headers.get("ETag"),
+            "last_modified": res.headers.get("Last-Modified"),
+            "fresh_until": time.time() + PAGE_CACHE_TTL,
+        })
+        return text
+    except httpx.HTTPError as e:
         return f"❌ Failed to retrieve/process {url}: {e}"
     except Exception as e:
         return f"❌ An unexpected error occurred extracting from {url}: {e}"
@@ -111,9 +256,23 @@ def extract_text_from_url(url, headers):
 # --- Pydantic Model for Request Body ---
 class HistoryChatRequest(BaseModel):
     question: str
+    chat_id: str | None = None  # conversation memory is kept per chat
 
 
 # --- API Endpoint ---
+async def build_history_prompt(question: str, chat_id: str | None) -> str:
+    current_chat_history = await memory.load_history(chat_id)
+    context = ""
+    websearch = await search_web(question)
+
+    return prompt_template.format(
+        question=question,
+        context=context,
+        websearch=websearch,
+        chat_history=current_chat_history,
+    )
+
+
 @router.post("/chat", tags=["History Chatbot"])
 async def handle_history_chat(request_data: HistoryChatRequest):
     """
@@ -121,23 +280,45 @@ async def handle_history_chat(request_data: HistoryChatRequest):
     Performs web search, formats prompt with provided history, and invokes the LLM.
     """
     try:
-        current_chat_history = memory.load_memory_variables({})["chat_history"]
-        context = ""
-        websearch = search_web(request_data.question)
-
-        prompt = prompt_template.format(
-            question=request_data.question,
-            context=context,
-            websearch=websearch,
-            chat_history=current_chat_history,
-        )
-
-        # Replace this with your actual model response logic
-        response = llm.invoke(prompt)
-        memory.save_context({"input": request_data.question}, {"output": response.content})
+        prompt = await build_history_prompt(request_data.question, request_data.chat_id)
+
+        response = await llm.ainvoke(prompt)
+        await memory.add_turn(request_data.chat_id, request_data.question, response.content)
         return response.content
 
     except Exception as e:
         print(f"Error in history chatbot endpoint: {e}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
+
+@router.post("/chat/stream", tags=["History Chatbot"])
+async def stream_history_chat(request_data: HistoryChatRequest):
+    """
+    Same as /chat, but streams the answer as server-sent events.
+    The turn is saved to memory once the full answer has been produced.
+    """
+    try:
+        prompt = await build_history_prompt(request_data.question, request_data.chat_id)
+    except Exception as e:
+        print(f"Error in history chatbot endpoint: {e}")
+        raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
+
+    async def events():
+        answer = ""
+        try:
+            async for text in stream_llm(llm, prompt):
+                answer += text
+                yield sse_event(text)
+        except Exception as e:
+            print(f"Error in history chatbot stream: {e}")
+            yield sse_event(f"Internal server error: {e}", event="error")
+            return
+        await memory.add_turn(request_data.chat_id, request_data.question, answer)
+        yield sse_event(answer, event="done")
+
+    return sse_response(events())
+
+
+@router.get("/cache_stats", tags=["History Chatbot"])
+async def cache_stats():
+    return {**page_cache_metrics, "entries": await asyncio.to_thread(len, page_cache)}
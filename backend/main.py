@@ -1,37 +1,69 @@
 import os
+import json
 import asyncio
 from datetime import datetime
 from pathlib import Path
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Request, Depends
+from fastapi import FastAPI, HTTPException, Request, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from motor.motor_asyncio import AsyncIOMotorClient
 from pydantic import BaseModel
 from bson import ObjectId
 import time
-from typing import Callable
-import requests
+from typing import Awaitable, Callable
 import httpx
 
-from clerk_backend_api import Clerk
-from clerk_backend_api.jwks_helpers import AuthenticateRequestOptions
 from history_chatbot import router as history_chatbot_router # Ensure you import the router
+from history_chatbot import memory as history_memory
 from rag_story import router as rag_story_router
+from upstream import UpstreamClient
+from video_jobs import VideoJobManager
+from video_download import download_video
+from streaming import iter_sse, sse_event, sse_response
+from pdf_render import LOGO_PATH, pdf_chunks, render_story_pdf, start_pool, shutdown_pool
+from auth import AuthError, ClerkJWTVerifier
+from chat_metadata import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, ChatMetadataStore
 
 
 
 # --- Constants ---
+# Default instances; UPSTREAM_CONFIG (hot-reloaded) lists the real ones, see upstreams.example.json
 VIDEO_STATIC_API = "http://d59d-34-143-176-229.ngrok-free.app"
 STORY_GEN_API = "http://94ad-34-168-181-25.ngrok-free.app"
 VIDEO_FLUID_API = "http://f828-34-87-156-40.ngrok-free.app"  # or your actual API
 
+# --- Shared upstream registry (least-loaded instances, health checks, circuit breakers) ---
+upstream = UpstreamClient(config_path=os.environ.get("UPSTREAM_CONFIG", "upstreams.json"))
+upstream.register("video_static", VIDEO_STATIC_API,
+                  timeout=httpx.Timeout(30.0, connect=10.0))
+upstream.register("video_fluid", VIDEO_FLUID_API,
+                  timeout=httpx.Timeout(40.0, connect=10.0))
+# The fine-tuned model runs up to 9 generate() steps, so allow a long read
+upstream.register("story_gen", STORY_GEN_API,
+                  timeout=httpx.Timeout(600.0, connect=10.0), retries=2)
+
+# Per-endpoint timeouts
+TRIGGER_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+POLL_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+DOWNLOAD_TIMEOUT = httpx.Timeout(30.0, connect=10.0, read=120.0)
+# The Colab servers hold /wait/{job_id} open for up to LONG_POLL_SECONDS
+LONG_POLL_SECONDS = 25
+LONG_POLL_TIMEOUT = httpx.Timeout(30.0, connect=10.0, read=LONG_POLL_SECONDS + 15.0)
+
 
 # --- Load .env ---
 load_dotenv()
 
 # --- Clerk Setup ---
-clerk_client = Clerk(bearer_auth=os.getenv("CLERK_SECRET_KEY"))
+# Session tokens are verified locally against Clerk's JWKS (see auth.py)
+clerk_auth = ClerkJWTVerifier(
+    jwks_url=os.getenv("CLERK_JWKS_URL"),
+    secret_key=os.getenv("CLERK_SECRET_KEY"),
+    authorized_parties=[os.environ.get("CLIENT_URL", "http://localhost:5173")],
+    issuer=os.getenv("CLERK_ISSUER"),
+)
 
 # --- FastAPI App ---
 app = FastAPI()
@@ -46,6 +78,20 @@ API_BASE_URL = "http://localhost:3000" # Adjust if your app runs on a different
 async def startup_event():
     global http_client
     http_client = httpx.AsyncClient(base_url=API_BASE_URL)
+    await clerk_auth.start()
+    await upstream.start()
+    await chat_metadata.ensure_indexes()
+    await video_jobs.start()
+    start_pool()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await video_jobs.stop()
+    shutdown_pool()
+    await clerk_auth.stop()
+    await http_client.aclose()
+    await upstream.aclose()
 
 
 app.add_middleware(
@@ -54,12 +100,17 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["Authorization", "Content-Type"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # --- MongoDB Setup ---
 MONGO_URL = os.environ.get("MONGO", "mongodb://localhost:27017")
 client = AsyncIOMotorClient(MONGO_URL)
 db = client["ASH_AI_Testing"]
+# History chatbot sessions are rebuilt from / summarised into db.chats
+history_memory.bind_collection(db.chats)
+# Sidebar listing (replaces the unbounded per-user db.userchats array)
+chat_metadata = ChatMetadataStore(db.chatmetadata)
 
 
 
@@ -67,71 +118,153 @@ db = client["ASH_AI_Testing"]
 class ChatCreate(BaseModel):
     text: str
     type: str
+    fresh: bool = False  # RAG Story: skip the story cache and generate a new variation
 
 class ChatUpdate(BaseModel):
     question: str | None = None
     answer: str
 
 # --- Clerk Auth Middleware ---
-def get_current_user(request: Request) -> str:
+async def get_current_user(request: Request) -> str:
     auth_header = request.headers.get("authorization")
     if not auth_header or not auth_header.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
 
     try:
-        dummy_request = httpx.Request(
-            method="GET",
-            url=str(request.url),
-            headers={"authorization": auth_header}
-        )
-        request_state = clerk_client.authenticate_request(
-            dummy_request,
-            AuthenticateRequestOptions(
-                authorized_parties=[os.environ.get("CLIENT_URL", "http://localhost:5173")]
-            )
-        )
-        if not request_state.is_signed_in:
-            raise HTTPException(status_code=401, detail="Token is invalid")
-        return request_state.payload.get("sub")
-    except Exception as e:
+        claims = await clerk_auth.verify(auth_header[len("Bearer "):])
+    except AuthError as e:
         raise HTTPException(status_code=401, detail=f"Token verification failed: {str(e)}")
+    return claims["sub"]
+
+# --- Chat history writes ---
+# Every append goes through push_history so that lastReply always points at the
+# newest model message and readers (PDF download) never scan the history array.
+DEFAULT_HISTORY_PAGE = 50
+MAX_HISTORY_PAGE = 200
+
+
+def message_text(message: dict) -> str:
+    return "".join(p.get("text", "") for p in message.get("parts", []))
+
+
+async def push_history(chat_id: str, user_id: str, *messages: dict):
+    update = {"$push": {"history": {"$each": list(messages)}}}
+    replies = [m for m in messages if m.get("role") == "model"]
+    if replies:
+        update["$set"] = {"lastReply": {"text": message_text(replies[-1]), "at": datetime.utcnow()}}
+    await db.chats.update_one({"_id": ObjectId(chat_id), "userId": user_id}, update)
+
+
+async def get_last_reply(chat_id: str, user_id: str) -> str | None:
+    """Text of the chat's newest model message, or None if the chat does not exist."""
+    chat = await db.chats.find_one({"_id": ObjectId(chat_id), "userId": user_id}, {"lastReply": 1})
+    if not chat:
+        return None
+    if "lastReply" in chat:
+        return chat["lastReply"]["text"]
+
+    # Chats written before lastReply existed: scan once, then backfill the pointer
+    chat = await db.chats.find_one({"_id": ObjectId(chat_id)}, {"history": 1})
+    text = ""
+    for item in reversed(chat.get("history", [])):
+        if item.get("role") == "model":
+            text = message_text(item)
+            break
+    if text:
+        await db.chats.update_one(
+            {"_id": ObjectId(chat_id), "lastReply": {"$exists": False}},
+            {"$set": {"lastReply": {"text": text, "at": datetime.utcnow()}}},
+        )
+    return text
+
 
 # --- Video Generation Helper ---
-async def generate_static_video(payload: dict, chat_id: str, user_id: str) -> str:
+async def report_progress(progress: Callable | None, stage: str, **fields):
+    if progress:
+        await progress(stage, **fields)
+
+
+async def wait_for_upstream_job(service: str, job_id: str, instance: str | None,
+                                poll: Callable[[], Awaitable[str]], poll_interval: float):
+    """
+    Returns once the upstream job is done (raises if it failed). Long-polls
+    ``/wait/{job_id}`` so completion is noticed immediately; servers without
+    that endpoint are polled with ``poll()`` every ``poll_interval`` seconds.
+    """
+    long_poll = True
+    while True:
+        if long_poll:
+            try:
+                resp = await upstream.get(service, f"/wait/{job_id}",
+                                          params={"timeout": LONG_POLL_SECONDS},
+                                          timeout=LONG_POLL_TIMEOUT, instance=instance)
+                body = resp.json()
+                status = body.get("status")
+                if status == "processing":
+                    continue
+                if status == "error":
+                    raise RuntimeError(f"Job failed: {body.get('error')}")
+                print(f"[{service}] job {job_id} finished")
+                return
+            except httpx.HTTPStatusError as e:
+                # A 404 for the route itself means an older server without /wait
+                missing_route = (
+                    e.response.status_code == 404
+                    and e.response.headers.get("Content-Type", "").startswith("application/json")
+                    and e.response.json().get("detail") == "Not Found"
+                )
+                if not missing_route:
+                    raise
+                print(f"[{service}] no /wait endpoint, falling back to polling")
+                long_poll = False
+
+        status = await poll()
+        print("Status:", status)
+        if status == "done":
+            return
+        await asyncio.sleep(poll_interval)
+
+
+async def generate_static_video(payload: dict, chat_id: str, user_id: str,
+                                progress: Callable | None = None,
+                                upstream_job_id: str | None = None,
+                                upstream_instance: str | None = None) -> str:
     try:
-        # 1. Trigger video job
-        print(payload)
-        resp = requests.post(f"{VIDEO_STATIC_API}/make_video", json={"story": payload["story"]})
-        resp.raise_for_status()
-        job_id = resp.json()["job_id"]
-        print(job_id)
-
-        # 2. Poll until complete
-        while True:
-            status_resp = requests.get(f"{VIDEO_STATIC_API}/job_status/{job_id}")
-            status_resp.raise_for_status()
+        # 1. Trigger video job (skipped when resuming an already submitted job);
+        #    the job only exists on the instance that accepted it
+        if upstream_job_id:
+            job_id, instance = upstream_job_id, upstream_instance
+        else:
+            print(payload)
+            resp = await upstream.post("video_static", "/make_video",
+                                       json={"story": payload["story"]}, timeout=TRIGGER_TIMEOUT)
+            job_id, instance = resp.json()["job_id"], upstream.instance_url(resp)
+            print(job_id, instance)
+        await report_progress(progress, "rendering", upstreamJobId=job_id, upstreamInstance=instance)
+
+        # 2. Wait until complete
+        async def poll_status() -> str:
+            status_resp = await upstream.get("video_static", f"/job_status/{job_id}",
+                                             timeout=POLL_TIMEOUT, instance=instance)
             status = status_resp.json()["status"]
-            print("Status:", status)
-            if status == "done":
-                break
-            elif status == "error":
+            if status == "error":
                 raise RuntimeError("Video job failed")
-            await asyncio.sleep(10)
+            return status
+
+        await wait_for_upstream_job("video_static", job_id, instance, poll_status, poll_interval=10)
 
-        # 3. Download the video
+        # 3. Download the video straight to disk (resumable, verified)
         print("After While True")
-        download_url = f"{VIDEO_STATIC_API}/get_video/{job_id}"
+        await report_progress(progress, "downloading")
+        download_url = f"/get_video/{job_id}"
         print("Download URL:", download_url)
-        video_resp = requests.get(download_url)
-        print(video_resp)
-        video_resp.raise_for_status()
-        video_bytes = video_resp.content
 
         # 4. Save locally
-        out_dir = Path("videos") / "Video Generation (Static)" / chat_id
-        out_dir.mkdir(parents=True, exist_ok=True)
-        path = out_dir / "output.mp4"
-        path.write_bytes(video_bytes)
+        path = await download_video(
+            upstream, "video_static", download_url,
+            Path("videos") / "Video Generation (Static)" / chat_id / "output.mp4",
+            timeout=DOWNLOAD_TIMEOUT, instance=instance,
+        )
 
         # 5. Store in DB
         video_path = str(path)
@@ -144,10 +277,7 @@ async def generate_static_video(payload: dict, chat_id: str, user_id: str) -> st
             "</video></div>"
         )
 
-        await db.chats.update_one(
-            {"_id": ObjectId(chat_id), "userId": user_id},
-            {"$push": {"history": {"role": "model", "parts": [{"text": html}]}}}
-        )
+        await push_history(chat_id, user_id, {"role": "model", "parts": [{"text": html}]})
 
         await db.videometadata.insert_one({
             "chatId": chat_id,
@@ -162,144 +292,130 @@ async def generate_static_video(payload: dict, chat_id: str, user_id: str) -> st
         raise HTTPException(status_code=500, detail=f"Video generation failed: {str(e)}")
 
 
-async def generate_fluid_video(payload: dict, chat_id: str, user_id: str) -> str:
+async def generate_fluid_video(payload: dict, chat_id: str, user_id: str,
+                               progress: Callable | None = None,
+                               upstream_job_id: str | None = None,
+                               upstream_instance: str | None = None) -> str:
     try:
-        # 1. Enqueue the job
-        enqueue_resp = requests.post(
-            f"{VIDEO_FLUID_API}/enqueue_story",
-            json={"story": payload["story"], "num_frames": 16},  # You can change frames as needed
-            timeout=10
-        )
-        enqueue_resp.raise_for_status()
-        job_id = enqueue_resp.json()["job_id"]
-        print("Fluid video job enqueued:", job_id)
+        # 1. Enqueue the job (skipped when resuming an already submitted job)
+        if upstream_job_id:
+            job_id, instance = upstream_job_id, upstream_instance
+        else:
+            enqueue_resp = await upstream.post(
+                "video_fluid", "/enqueue_story",
+                json={"story": payload["story"], "num_frames": 16},  # You can change frames as needed
+                timeout=TRIGGER_TIMEOUT
+            )
+            job_id, instance = enqueue_resp.json()["job_id"], upstream.instance_url(enqueue_resp)
+            print("Fluid video job enqueued:", job_id, instance)
+        await report_progress(progress, "rendering", upstreamJobId=job_id, upstreamInstance=instance)
+
+        # 2. Wait for completion
+        async def poll_result() -> str:
+            async with upstream.stream("video_fluid", "GET", f"/result/{job_id}",
+                                       timeout=DOWNLOAD_TIMEOUT, instance=instance) as poll_resp:
+                content_type = poll_resp.headers.get("Content-Type", "")
+
+                if content_type.startswith("application/json"):
+                    body = json.loads(await poll_resp.aread())
+                    status = body.get("status")
+                    if status == "error":
+                        raise RuntimeError(f"Job failed: {body.get('error')}")
+                    print(f"[{job_id}] still processing…")
+                    return status
 
-        # 2. Poll for completion
-        while True:
-            poll_resp = requests.get(f"{VIDEO_FLUID_API}/result/{job_id}", stream=True, timeout=30)
-            content_type = poll_resp.headers.get("Content-Type", "")
+                elif content_type == "video/mp4":
+                    # Ready: the body is fetched by the download stage below
+                    return "done"
 
-            if content_type.startswith("application/json"):
-                status = poll_resp.json().get("status")
-                if status == "processing":
-                    print(f"[{job_id}] still processing…")
-                    await asyncio.sleep(5)
-                    continue
-                elif status == "error":
-                    raise RuntimeError(f"Job failed: {poll_resp.json().get('error')}")
-
-            elif content_type == "video/mp4":
-                # Save the video
-                out_dir = Path("videos") / "Video Generation (Fluid)" / chat_id
-                print("video saved")
-                out_dir.mkdir(parents=True, exist_ok=True)
-                path = out_dir / "output.mp4"
-
-                with open(path, "wb") as f:
-                    for chunk in poll_resp.iter_content(8192):
-                        f.write(chunk)
-
-                video_path = str(path)
-                print(f"[{job_id}] video saved → {video_path}")
-
-                # 3. Store in DB
-                html = (
-                    "<div style='display:flex; justify-content:center; margin: 20px 0;'>"
-                    f"<video width='720' height='405' controls style='border-radius:12px;'>"
-                    f"<source src='http://localhost:3000/{video_path}' type='video/mp4'>"
-                    "Your browser does not support the video tag."
-                    "</video></div>"
-                )
+                else:
+                    raise RuntimeError(f"Unexpected response type: {content_type}")
 
-                await db.chats.update_one(
-                    {"_id": ObjectId(chat_id), "userId": user_id},
-                    {"$push": {"history": {"role": "model", "parts": [{"text": html}]}}}
-                )
+        await wait_for_upstream_job("video_fluid", job_id, instance, poll_result, poll_interval=5)
 
-                await db.videometadata.insert_one({
-                    "chatId": chat_id,
-                    "userId": user_id,
-                    "prompt": payload["story"],
-                    "videoPath": video_path,
-                    "createdAt": datetime.utcnow()
-                })
+        # Save the video (resumable, verified)
+        await report_progress(progress, "downloading")
+        path = await download_video(
+            upstream, "video_fluid", f"/result/{job_id}",
+            Path("videos") / "Video Generation (Fluid)" / chat_id / "output.mp4",
+            timeout=DOWNLOAD_TIMEOUT, instance=instance,
+        )
+        video_path = str(path)
+        print(f"[{job_id}] video saved → {video_path}")
 
-                return html
+        # 3. Store in DB
+        html = (
+            "<div style='display:flex; justify-content:center; margin: 20px 0;'>"
+            f"<video width='720' height='405' controls style='border-radius:12px;'>"
+            f"<source src='http://localhost:3000/{video_path}' type='video/mp4'>"
+            "Your browser does not support the video tag."
+            "</video></div>"
+        )
 
-            else:
-                raise RuntimeError(f"Unexpected response type: {content_type}")
+        await push_history(chat_id, user_id, {"role": "model", "parts": [{"text": html}]})
+
+        await db.videometadata.insert_one({
+            "chatId": chat_id,
+            "userId": user_id,
+            "prompt": payload["story"],
+            "videoPath": video_path,
+            "createdAt": datetime.utcnow()
+        })
+
+        return html
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Fluid video generation failed: {str(e)}")
 
 
 
-# --- Function to call the History Chatbot API (Simplified) ---
-async def chat_with_history_chatbot_api(prompt: str) -> str: # chat_history parameter is still here but not sent to API
-    """
-    Calls the stateful History Chatbot API endpoint.
-    Only sends the question, as the API manages history internally.
-    The 'chat_history' parameter from main.py is ignored when calling the API.
-    """
+# --- Internal router calls (streamed over SSE) ---
+# Web search + Gemini can take a while before the first token arrives
+INTERNAL_STREAM_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
 
-    api_endpoint = "/history_chatbot/chat" # Adjust the endpoint based on how the router is mounted
-
-    # Construct the payload, ONLY including the question
-    payload = {
-        "question": prompt,
-    }
 
+async def stream_internal_api(api_endpoint: str, payload: dict):
+    """
+    Calls one of the mounted routers' SSE endpoints and yields text chunks as
+    they arrive. Errors are raised as HTTPException like the other helpers.
+    """
     try:
-        response = await http_client.post(api_endpoint, json=payload)
-        response.raise_for_status()
-        return response.json()
+        async with http_client.stream("POST", api_endpoint, json=payload,
+                                      timeout=INTERNAL_STREAM_TIMEOUT) as response:
+            if response.is_error:
+                await response.aread()
+                response.raise_for_status()
+            async for event, data in iter_sse(response):
+                if event == "chunk":
+                    yield data
+                elif event == "error":
+                    raise HTTPException(status_code=500, detail=f"API error: {data}")
 
     except httpx.HTTPStatusError as e:
-        print(f"HTTP error calling history chatbot API: {e}")
+        print(f"HTTP error calling {api_endpoint}: {e}")
         raise HTTPException(status_code=e.response.status_code, detail=f"API error: {e.response.text}")
     except httpx.RequestError as e:
-        print(f"Request error calling history chatbot API: {e}")
+        print(f"Request error calling {api_endpoint}: {e}")
         raise HTTPException(status_code=500, detail=f"API request failed: {e}")
-    except Exception as e:
-        print(f"An unexpected error occurred calling history chatbot API: {e}")
-        raise HTTPException(status_code=500, detail=f"Internal server error calling API: {e}")
 
-async def generate_rag_story(prompt: str) -> str: # chat_history parameter is still here but not sent to API
+
+def chat_with_history_chatbot_api(prompt: str, chat_id: str | None = None):
     """
-    Calls the stateful History Chatbot API endpoint.
-    Only sends the question, as the API manages history internally.
-    The 'chat_history' parameter from main.py is ignored when calling the API.
+    Streams an answer from the stateful History Chatbot API.
+    Only sends the question and chat id, as the API manages history per chat.
     """
+    return stream_internal_api("/history_chatbot/chat/stream", {"question": prompt, "chat_id": chat_id})
 
-    api_endpoint = "/rag_story/chat" # Adjust the endpoint based on how the router is mounted
 
-    # Construct the payload, ONLY including the question
-    payload = {
-        "query": prompt,
-    }
+def generate_rag_story(prompt: str, fresh: bool = False):
+    """Streams a story from the RAG Story API; ``fresh`` bypasses its story cache."""
+    return stream_internal_api("/rag_story/chat/stream", {"query": prompt, "fresh": fresh})
 
-    try:
-        response = await http_client.post(api_endpoint, json=payload)
-        response.raise_for_status()
-        return response.json()
-
-    except httpx.HTTPStatusError as e:
-        print(f"HTTP error calling history chatbot API: {e}")
-        raise HTTPException(status_code=e.response.status_code, detail=f"API error: {e.response.text}")
-    except httpx.RequestError as e:
-        print(f"Request error calling history chatbot API: {e}")
-        raise HTTPException(status_code=500, detail=f"API request failed: {e}")
-    except Exception as e:
-        print(f"An unexpected error occurred calling history chatbot API: {e}")
-        raise HTTPException(status_code=500, detail=f"Internal server error calling API: {e}")
-
-
-import requests
 
 
 async def generate_story(prompt: str) -> str:
     """
-    Calls the Full Story Generation API using requests (sync).
+    Calls the Full Story Generation API through the shared upstream client.
     """
 
 
@@ -310,12 +426,11 @@ async def generate_story(prompt: str) -> str:
     }
 
     try:
-        resp = requests.post(f"{STORY_GEN_API}/generate_story/", json=payload)
-        resp.raise_for_status()
+        resp = await upstream.post("story_gen", "/generate_story/", json=payload)
         result = resp.json()
         return result.get("story", "⚠️ No story returned.")
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Story generation API request error: {e}")
         raise HTTPException(status_code=500, detail="Failed to generate story.")
 
@@ -326,21 +441,18 @@ async def generate_story(prompt: str) -> str:
 
 # --- Model Selector ---
 # --- Modified get_model_for_type (No change needed here) ---
-def get_model_for_type(chat_type: str) -> Callable:
+def get_model_for_type(chat_type: str, chat_id: str | None = None, fresh: bool = False) -> Callable:
     async def passthrough_model(question: str, history: list):
         yield "🚧 Model not yet implemented for this type."
 
     if chat_type == "History ChatBot":
         async def history_wrapper(prompt: str):
-            answer = await chat_with_history_chatbot_api(prompt)
-            yield answer
+            async for chunk in chat_with_history_chatbot_api(prompt, chat_id):
+                yield chunk
         return history_wrapper
 
     if chat_type == "RAG Story Generation":
-        async def rag_wrapper(prompt: str):
-            answer = await generate_rag_story(prompt)
-            yield answer
-        return rag_wrapper
+        return lambda prompt: generate_rag_story(prompt, fresh)
 
     if chat_type == "Story Generation":
         async def story_wrapper(prompt: str):
@@ -352,256 +464,239 @@ def get_model_for_type(chat_type: str) -> Callable:
         return passthrough_model
 
 
-# --- Helpers ---
-def obj_id_to_str(document: dict) -> dict:
-    document["_id"] = str(document["_id"])
-    return document
+# --- Background Video Jobs ---
+VIDEO_CHAT_TYPES = ("Video Generation (Static)", "Video Generation (Fluid)")
 
-# --- Routes ---
-@app.post("/api/chats", status_code=201)
-async def create_chat(chat_data: ChatCreate, user_id: str = Depends(get_current_user)):
-    new_chat = {
-        "userId": user_id,
-        "type": chat_data.type,
-        "history": [{"role": "user", "parts": [{"text": chat_data.text}]}],
-        "createdAt": datetime.utcnow(),
-    }
 
-    result = await db.chats.insert_one(new_chat)
-    chat_id = str(result.inserted_id)
+async def push_video_failure(job: dict, error: Exception):
+    detail = getattr(error, "detail", None) or str(error)
+    await push_history(job["chatId"], job["userId"],
+                       {"role": "model", "parts": [{"text": f"⚠️ {detail}"}]})
 
-    if chat_data.type == "Video Generation (Static)":
-        # 1. First, call the RAG Story model with user prompt
-        model_fn = get_model_for_type("RAG Story Generation")
-        generated_story = ""
-        async for chunk in model_fn(chat_data.text):
-            generated_story += chunk
+
+async def run_static_video_job(job: dict, progress: Callable) -> str:
+    state = job.get("state", {})
+    prompt = job["payload"]["prompt"]
+    try:
+        # 1. First, call the RAG Story model with user prompt (kept across restarts)
+        generated_story = state.get("story")
+        if generated_story is None:
+            await progress("story")
+            model_fn = get_model_for_type("RAG Story Generation")
+            generated_story = ""
+            async for chunk in model_fn(prompt):
+                generated_story += chunk
+            await progress("story_ready", story=generated_story)
 
         # 2. Then, pass the generated story to the video generator
-        await generate_static_video(
+        return await generate_static_video(
             {
                 "story": generated_story,    # Generated story used for making video
-                "prompt": chat_data.text      # Original user input to RAG, saved in DB
+                "prompt": prompt              # Original user input to RAG, saved in DB
             },
-            chat_id,
-            user_id
+            job["chatId"],
+            job["userId"],
+            progress=progress,
+            upstream_job_id=state.get("upstreamJobId"),
+            upstream_instance=state.get("upstreamInstance"),
         )
+    except Exception as e:
+        await push_video_failure(job, e)
+        raise
 
-    elif chat_data.type == "Video Generation (Fluid)":
 
-        await generate_fluid_video(
+async def run_fluid_video_job(job: dict, progress: Callable) -> str:
+    state = job.get("state", {})
+    try:
+        return await generate_fluid_video(
             {
-                "story": chat_data.text,
+                "story": job["payload"]["prompt"],
             },
-            chat_id,
-            user_id
+            job["chatId"],
+            job["userId"],
+            progress=progress,
+            upstream_job_id=state.get("upstreamJobId"),
+            upstream_instance=state.get("upstreamInstance"),
         )
+    except Exception as e:
+        await push_video_failure(job, e)
+        raise
 
-    else:
-        model_fn = get_model_for_type(chat_data.type)
-        accumulated_text = ""
-        async for chunk in model_fn(chat_data.text):
-            accumulated_text += chunk
-        await db.chats.update_one(
-            {"_id": result.inserted_id},
-            {"$push": {"history": {"role": "model", "parts": [{"text": accumulated_text}]}}}
-        )
 
-    chat_entry = {
-        "_id": chat_id,
-        "title": chat_data.text[:40],
-        "createdAt": datetime.utcnow(),
+video_jobs = VideoJobManager(db.videojobs, {
+    "Video Generation (Static)": run_static_video_job,
+    "Video Generation (Fluid)": run_fluid_video_job,
+})
+
+
+# --- Helpers ---
+def obj_id_to_str(document: dict) -> dict:
+    document["_id"] = str(document["_id"])
+    return document
+
+# --- Routes ---
+@app.post("/api/chats", status_code=201)
+async def create_chat(chat_data: ChatCreate, stream: bool = False,
+                      user_id: str = Depends(get_current_user)):
+    # The id is generated here so the chat and its sidebar entry are written together
+    chat_oid = ObjectId()
+    chat_id = str(chat_oid)
+    created_at = datetime.utcnow()
+    new_chat = {
+        "_id": chat_oid,
+        "userId": user_id,
         "type": chat_data.type,
+        "history": [{"role": "user", "parts": [{"text": chat_data.text}]}],
+        "createdAt": created_at,
     }
 
-    existing = await db.userchats.find_one({"userId": user_id})
-    if not existing:
-        await db.userchats.insert_one({"userId": user_id, "chats": [chat_entry]})
-    else:
-        await db.userchats.update_one({"userId": user_id}, {"$push": {"chats": chat_entry}})
+    await asyncio.gather(
+        db.chats.insert_one(new_chat),
+        chat_metadata.add(chat_oid, user_id, chat_data.type, chat_data.text, created_at),
+    )
+
+    if chat_data.type in VIDEO_CHAT_TYPES:
+        # Video runs take minutes: hand them to the job workers and answer right away
+        job_id = await video_jobs.submit(chat_data.type, {"prompt": chat_data.text}, chat_id, user_id)
+        return JSONResponse(status_code=202, content={"chatId": chat_id, "jobId": job_id})
+
+    model_fn = get_model_for_type(chat_data.type, chat_id, chat_data.fresh)
+
+    async def save_reply(accumulated_text: str):
+        await push_history(chat_id, user_id, {"role": "model", "parts": [{"text": accumulated_text}]})
+
+    if stream:
+        # SSE: a "chat" event with the id, text chunks, then "done" once persisted
+        async def events():
+            yield sse_event({"chatId": chat_id}, event="chat")
+            accumulated_text, error = "", None
+            try:
+                async for chunk in model_fn(chat_data.text):
+                    accumulated_text += chunk
+                    yield sse_event(chunk)
+            except HTTPException as e:
+                error = e.detail
+            except Exception as e:
+                error = str(e)
+            finally:
+                # Whatever was generated is kept, even if the client went away
+                await asyncio.shield(save_reply(accumulated_text))
+            if error is not None:
+                yield sse_event(error, event="error")
+                return
+            yield sse_event({"chatId": chat_id}, event="done")
+
+        return sse_response(events())
 
+    accumulated_text = ""
+    async for chunk in model_fn(chat_data.text):
+        accumulated_text += chunk
+    await save_reply(accumulated_text)
     return chat_id
 
 
-@app.get("/api/userchats")
-async def get_user_chats(request: Request, user_id: str = Depends(get_current_user)):
-    chat_type = request.query_params.get("type")
-    userchats = await db.userchats.find_one({"userId": user_id})
-    if not userchats:
-        return []
-    chats = userchats["chats"]
-    if chat_type:
-        chats = [c for c in chats if c.get("type") == chat_type]
-    for chat in chats:
-        chat["_id"] = str(chat["_id"])
-    return chats
+@app.get("/api/upstreams")
+async def get_upstreams(user_id: str = Depends(get_current_user)):
+    # Instance health, circuit state and load per upstream service
+    return upstream.snapshot()
 
-@app.get("/api/chats/{chat_id}")
-async def get_chat(chat_id: str, user_id: str = Depends(get_current_user)):
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str, user_id: str = Depends(get_current_user)):
     try:
-        chat = await db.chats.find_one({"_id": ObjectId(chat_id), "userId": user_id})
+        job = await video_jobs.get(job_id, user_id)
     except Exception:
-        raise HTTPException(status_code=400, detail="Invalid chat ID")
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-    return obj_id_to_str(chat)
-
-import io
-from pathlib import Path
-from fastapi import HTTPException, Depends
-from fastapi.responses import StreamingResponse
-from bson import ObjectId
-
-import os
-from weasyprint import HTML
-
-# 1️⃣ Paths
-FONT_PATH = "PDF Generation/fonts/Jameel Noori Nastaleeq Regular.ttf"
-LOGO_PATH = "PDF Generation/logo.png"  # Optional: Set None if no logo
-
-
-def create_urdu_pdf_weasyprint(text_content: str,
-                               watermark_text="Generated By ASH AI",
-                               logo_path=None) -> bytes:
-    abs_font_path = os.path.abspath(FONT_PATH)
-    abs_logo_path = os.path.abspath(logo_path) if logo_path else None
-
-    html_content = f"""
-    <!DOCTYPE html>
-    <html lang="ur">
-    <head>
-      <meta charset="utf-8">
-      <title>Urdu Document</title>
-      <style>
-        @font-face {{
-          font-family: 'UrduFont';
-          src: url('file://{abs_font_path}') format('truetype');
-        }}
-
-        /* BODY & TYPOGRAPHY */
-        body {{
-          background-color: #202229;
-          color: white;
-          font-family: 'UrduFont', sans-serif;
-          direction: rtl;
-          text-align: justify;
-          margin: 0.3in 0.4in;
-          font-size: 16pt;
-          line-height: 1.6;
-          letter-spacing: 0.5px;
-        }}
-        p {{
-          text-indent: 2em;
-          margin-bottom: 1.2em;
-          font-size: 18pt;
-        }}
-
-        /* FIRST-PAGE HEADER */
-        header.docHeader {{
-          position: running(docHeader);
-          margin-top: 15px;         /* push the logo down */
-          /* border-bottom removed */
-        }}
-        .headerLogo {{
-          height: 60px;
-        }}
-
-        @page:first {{
-          background-color: #202229;
-          @top-left {{
-            content: element(docHeader);
-          }}
-          @bottom-left {{
-            content: element(docFooter);
-          }}
-        }}
-
-        /* FOOTER ON ALL PAGES */
-        footer.docFooter {{
-          position: running(docFooter);
-        }}
-        @page {{
-          background-color: #202229;
-          @bottom-left {{
-            content: element(docFooter);
-          }}
-        }}
-        .watermark {{
-          display: flex;
-          direction: ltr;
-          align-items: center;
-          gap: 0px;
-          color: white;
-          font-size: 10pt;
-          font-weight: bold;
-        }}
-        .watermark img {{
-          height: 28px;
-          filter: brightness(0) invert(1);
-        }}
-      </style>
-    </head>
-    <body>
-
-      <!-- Header (only on page 1) -->
-      {f'''
-      <header class="docHeader">
-        <img src="file://{abs_logo_path}" class="headerLogo" alt="Logo">
-      </header>
-      ''' if abs_logo_path else ''}
-
-      <!-- Main content -->
-      <div class="content">
-        <p>{text_content.replace('\n', '</p><p>')}</p>
-      </div>
-
-      <!-- Footer on every page -->
-      <footer class="docFooter watermark">
-        {f'<img src="file://{abs_logo_path}" alt="Logo">' if abs_logo_path else ''}
-        {watermark_text}
-      </footer>
-    </body>
-    </html>
-    """
-    return HTML(string=html_content).write_pdf()
+        raise HTTPException(status_code=400, detail="Invalid job ID")
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 
+@app.get("/api/userchats")
+async def get_user_chats(response: Response, type: str | None = None,
+                         limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                         cursor: str | None = None,
+                         user_id: str = Depends(get_current_user)):
+    # Newest first; the next page's cursor is returned in the X-Next-Cursor header
+    try:
+        chats, next_cursor = await chat_metadata.list(user_id, type, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return [obj_id_to_str(chat) for chat in chats]
 
+@app.get("/api/chats/{chat_id}")
+async def get_chat(chat_id: str,
+                   limit: int | None = Query(None, ge=1, le=MAX_HISTORY_PAGE),
+                   before: int | None = Query(None, ge=0),
+                   user_id: str = Depends(get_current_user)):
+    """
+    Without parameters the whole history is returned. With ``limit`` only the
+    latest ``limit`` messages are, and ``before`` (a historyStart from a previous
+    response) pages further back. ``messageCount`` is the full history length.
+    """
+    try:
+        chat_oid = ObjectId(chat_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid chat ID")
 
+    start = None
+    if limit is None and before is None:
+        window = "$history"
+    elif before is None:
+        window = {"$slice": ["$history", -(limit or DEFAULT_HISTORY_PAGE)]}
+    else:
+        start = max(0, before - (limit or DEFAULT_HISTORY_PAGE))
+        # $slice needs a positive count; an empty window is trimmed below
+        window = {"$slice": ["$history", start, max(before - start, 1)]}
+
+    chats = await db.chats.aggregate([
+        {"$match": {"_id": chat_oid, "userId": user_id}},
+        {"$set": {"messageCount": {"$size": {"$ifNull": ["$history", []]}},
+                  "history": window}},
+        {"$unset": "lastReply"},
+    ]).to_list(length=1)
+    if not chats:
+        raise HTTPException(status_code=404, detail="Chat not found")
 
+    chat = chats[0]
+    if start is None:
+        chat["historyStart"] = chat["messageCount"] - len(chat["history"])
+    else:
+        chat["history"] = chat["history"][:before - start]
+        chat["historyStart"] = min(start, chat["messageCount"])
+    return obj_id_to_str(chat)
 
 # 3️⃣ FastAPI Endpoint
 @app.get("/api/chats/{chat_id}/pdf")
 async def download_story_pdf(chat_id: str, user_id: str = Depends(get_current_user)):
-    # 1) Fetch and authorize
-    chat = await db.chats.find_one({"_id": ObjectId(chat_id), "userId": user_id})
-    if not chat:
+    # 1) Fetch and authorize, reading only the last model reply
+    story = await get_last_reply(chat_id, user_id)
+    if story is None:
         raise HTTPException(404, "Chat not found")
 
-    # 2) Extract last model reply
-    history = chat.get("history", [])
-    story = ""
-    for item in reversed(history):
-        if item.get("role") == "model":
-            story = "".join(p["text"] for p in item.get("parts", []))
-            break
+    # 2) Nothing to render yet
     if not story:
         raise HTTPException(400, "No story to generate PDF")
 
-    # 3) Generate Urdu PDF with watermark at the end
-    pdf_bytes = create_urdu_pdf_weasyprint(story, watermark_text="Generated By ASH AI", logo_path=LOGO_PATH)
+    # 3) Generate Urdu PDF with watermark at the end (process pool, cached by content)
+    pdf_file = await render_story_pdf(story, watermark_text="Generated By ASH AI", logo_path=LOGO_PATH)
 
-    # 4) Stream back
+    # 4) Stream back from the already-open file
+    size = pdf_file.seek(0, os.SEEK_END)
+    pdf_file.seek(0)
     return StreamingResponse(
-        io.BytesIO(pdf_bytes),
+        pdf_chunks(pdf_file),
         media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename=Story.pdf"},
+        headers={"Content-Disposition": f"attachment; filename=Story.pdf", "Content-Length": str(size)},
     )
 
 
 
 @app.post("/api/chats/{chat_id}/message")
-async def generate_message(chat_id: str, payload: dict, user_id: str = Depends(get_current_user)):
+async def generate_message(chat_id: str, payload: dict, stream: bool = False,
+                           user_id: str = Depends(get_current_user)):
     question = payload.get("question")
     if not question:
         raise HTTPException(status_code=400, detail="Question is required")
@@ -612,19 +707,40 @@ async def generate_message(chat_id: str, payload: dict, user_id: str = Depends(g
 
     chat_type = chat.get("type", "Story Generation")  # Default is Story Generation if not set
 
-    model_fn = get_model_for_type(chat_type)
+    model_fn = get_model_for_type(chat_type, chat_id, bool(payload.get("fresh", False)))
+
+    async def save_turn(accumulated_text: str):
+        await push_history(
+            chat_id, user_id,
+            {"role": "user", "parts": [{"text": question}]},
+            {"role": "model", "parts": [{"text": accumulated_text}]},
+        )
+
+    if stream:
+        async def events():
+            accumulated_text, error = "", None
+            try:
+                async for chunk in model_fn(question):
+                    accumulated_text += chunk
+                    yield sse_event(chunk)
+            except HTTPException as e:
+                error = e.detail
+            except Exception as e:
+                error = str(e)
+            finally:
+                # Whatever was generated is kept, even if the client went away
+                await asyncio.shield(save_turn(accumulated_text))
+            if error is not None:
+                yield sse_event(error, event="error")
+                return
+            yield sse_event({"answer": accumulated_text}, event="done")
+
+        return sse_response(events())
+
     accumulated_text = ""
     async for chunk in model_fn(question):
         accumulated_text += chunk
-
-    new_items = [
-        {"role": "user", "parts": [{"text": question}]},
-        {"role": "model", "parts": [{"text": accumulated_text}]}
-    ]
-    await db.chats.update_one(
-        {"_id": ObjectId(chat_id), "userId": user_id},
-        {"$push": {"history": {"$each": new_items}}}
-    )
+    await save_turn(accumulated_text)
 
     return {"answer": accumulated_text}
 
@@ -0,0 +1,90 @@
+# migrate_userchats.py
+"""
+One-off migration from the old per-user ``userchats`` documents to the
+``chatmetadata`` collection (one document per chat, see chat_metadata.py).
+
+Entries keep their chat id as ``_id`` and are upserted with $setOnInsert, so
+the script is safe to re-run and never overwrites entries written by the
+running backend. Old documents are left in place unless --drop is given.
+
+    python migrate_userchats.py [--dry-run] [--drop] [--batch-size 1000]
+"""
+import argparse
+import os
+from datetime import datetime
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+
+from chat_metadata import INDEXES, metadata_doc
+
+DB_NAME = "ASH_AI_Testing"
+
+
+def entry_ops(user_id: str, chats: list[dict]) -> tuple[list[UpdateOne], int]:
+    ops, skipped = [], 0
+    for entry in chats:
+        chat_id = str(entry.get("_id", ""))
+        if not ObjectId.is_valid(chat_id):
+            skipped += 1
+            continue
+        doc = metadata_doc(
+            ObjectId(chat_id),
+            user_id,
+            entry.get("type"),
+            entry.get("title") or "",
+            entry.get("createdAt") or ObjectId(chat_id).generation_time.replace(tzinfo=None),
+        )
+        ops.append(UpdateOne({"_id": doc.pop("_id")}, {"$setOnInsert": doc}, upsert=True))
+    return ops, skipped
+
+
+def migrate(db, batch_size: int, dry_run: bool, drop: bool):
+    if not dry_run:
+        for keys, options in INDEXES:
+            db.chatmetadata.create_index(keys, **options)
+
+    users = entries = inserted = skipped = 0
+    pending: list[UpdateOne] = []
+
+    def flush():
+        nonlocal inserted, pending
+        if pending and not dry_run:
+            result = db.chatmetadata.bulk_write(pending, ordered=False)
+            inserted += result.upserted_count
+        pending = []
+
+    for userchats in db.userchats.find({}, {"userId": 1, "chats": 1}):
+        ops, bad = entry_ops(userchats["userId"], userchats.get("chats", []))
+        users += 1
+        entries += len(ops)
+        skipped += bad
+        pending.extend(ops)
+        if len(pending) >= batch_size:
+            flush()
+    flush()
+
+    print(f"👥 {users} user(s), {entries} chat entries, {skipped} skipped (invalid id)")
+    if dry_run:
+        print("🔍 Dry run: nothing written")
+        return
+    print(f"✅ {inserted} new chatmetadata document(s), {entries - inserted} already present")
+
+    if drop:
+        db.userchats.drop()
+        print("🗑️ Dropped userchats")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move userchats arrays into the chatmetadata collection")
+    parser.add_argument("--dry-run", action="store_true", help="Count entries without writing")
+    parser.add_argument("--drop", action="store_true", help="Drop userchats once migrated")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    load_dotenv()
+    client = MongoClient(os.environ.get("MONGO", "mongodb://localhost:27017"))
+    started = datetime.utcnow()
+    migrate(client[DB_NAME], args.batch_size, args.dry_run, args.drop)
+    print(f"⏱️ Done in {(datetime.utcnow() - started).total_seconds():.1f}s")
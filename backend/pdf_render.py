@@ -0,0 +1,244 @@
+# pdf_render.py
+"""
+Urdu story PDF rendering.
+
+WeasyPrint lays out Nastaliq text slowly, so rendering runs in a process
+pool whose workers load the font and compile the stylesheet once at startup
+(and warm up with a tiny document). Finished PDFs are cached on disk by a
+hash of (story, template version, watermark, logo) so repeated downloads are
+served straight from the file.
+
+Workers are started with ``forkserver`` rather than forked from the server
+process, so they do not inherit its threads (motor, httpx, executors) or
+any lock those threads held.
+"""
+import asyncio
+import html
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import BinaryIO, Iterator
+
+from cache import FileCache, make_key
+
+# 1️⃣ Paths
+FONT_PATH = "PDF Generation/fonts/Jameel Noori Nastaleeq Regular.ttf"
+LOGO_PATH = "PDF Generation/logo.png"  # Optional: Set None if no logo
+
+# Bump whenever STYLESHEET or the page markup changes
+PDF_TEMPLATE_VERSION = 1
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", "2"))
+
+pdf_cache = FileCache("cache/pdfs", suffix=".pdf",
+                      max_bytes=int(os.environ.get("PDF_CACHE_MAX_BYTES", str(256 * 1024 * 1024))))
+
+STYLESHEET = """
+@font-face {
+  font-family: 'UrduFont';
+  src: url('file://%(font_path)s') format('truetype');
+}
+
+/* BODY & TYPOGRAPHY */
+body {
+  background-color: #202229;
+  color: white;
+  font-family: 'UrduFont', sans-serif;
+  direction: rtl;
+  text-align: justify;
+  margin: 0.3in 0.4in;
+  font-size: 16pt;
+  line-height: 1.6;
+  letter-spacing: 0.5px;
+}
+p {
+  text-indent: 2em;
+  margin-bottom: 1.2em;
+  font-size: 18pt;
+}
+
+/* FIRST-PAGE HEADER */
+header.docHeader {
+  position: running(docHeader);
+  margin-top: 15px;         /* push the logo down */
+}
+.headerLogo {
+  height: 60px;
+}
+
+@page:first {
+  background-color: #202229;
+  @top-left {
+    content: element(docHeader);
+  }
+  @bottom-left {
+    content: element(docFooter);
+  }
+}
+
+/* FOOTER ON ALL PAGES */
+footer.docFooter {
+  position: running(docFooter);
+}
+@page {
+  background-color: #202229;
+  @bottom-left {
+    content: element(docFooter);
+  }
+}
+.watermark {
+  display: flex;
+  direction: ltr;
+  align-items: center;
+  gap: 0px;
+  color: white;
+  font-size: 10pt;
+  font-weight: bold;
+}
+.watermark img {
+  height: 28px;
+  filter: brightness(0) invert(1);
+}
+"""
+
+# --- Worker process state (set once by _init_worker) ---
+_font_config = None
+_stylesheet = None
+
+
+def _init_worker():
+    global _font_config, _stylesheet
+    from weasyprint import CSS
+    from weasyprint.text.fonts import FontConfiguration
+
+    _font_config = FontConfiguration()
+    _stylesheet = CSS(string=STYLESHEET % {"font_path": os.path.abspath(FONT_PATH)},
+                      font_config=_font_config)
+    # Warm up: the first layout loads the Nastaliq font and shaping caches
+    create_urdu_pdf_weasyprint("اردو")
+
+
+def build_story_html(text_content: str, watermark_text: str, logo_path=None) -> str:
+    abs_logo_path = os.path.abspath(logo_path) if logo_path else None
+    paragraphs = "</p><p>".join(html.escape(line) for line in text_content.split("\n"))
+    logo_header = (
+        f'<header class="docHeader"><img src="file://{abs_logo_path}" class="headerLogo" alt="Logo"></header>'
+        if abs_logo_path else ""
+    )
+    logo_footer = f'<img src="file://{abs_logo_path}" alt="Logo">' if abs_logo_path else ""
+
+    return f"""
+    <!DOCTYPE html>
+    <html lang="ur">
+    <head>
+      <meta charset="utf-8">
+      <title>Urdu Document</title>
+    </head>
+    <body>
+
+      <!-- Header (only on page 1) -->
+      {logo_header}
+
+      <!-- Main content -->
+      <div class="content">
+        <p>{paragraphs}</p>
+      </div>
+
+      <!-- Footer on every page -->
+      <footer class="docFooter watermark">
+        {logo_footer}
+        {watermark_text}
+      </footer>
+    </body>
+    </html>
+    """
+
+
+def create_urdu_pdf_weasyprint(text_content: str,
+                               watermark_text="Generated By ASH AI",
+                               logo_path=None) -> bytes:
+    from weasyprint import HTML
+
+    if _stylesheet is None:
+        _init_worker()
+    return HTML(string=build_story_html(text_content, watermark_text, logo_path)).write_pdf(
+        stylesheets=[_stylesheet], font_config=_font_config
+    )
+
+
+# --- Async API used by the endpoints ---
+_pool: ProcessPoolExecutor | None = None
+_in_flight: dict[str, asyncio.Task] = {}
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, initializer=_init_worker,
+                                    mp_context=multiprocessing.get_context("forkserver"))
+    return _pool
+
+
+def start_pool():
+    """Spawns and warms the workers so the first download does not pay for it."""
+    pool = get_pool()
+    for _ in range(PDF_WORKERS):
+        pool.submit(int)
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def render_story_pdf(story: str, watermark_text: str = "Generated By ASH AI",
+                           logo_path=LOGO_PATH) -> BinaryIO:
+    """
+    Returns the rendered PDF as a file object to stream (see ``pdf_chunks``),
+    rendering it off the loop on a cache miss. A cached file is returned
+    already open, so cache eviction cannot remove it before it is sent.
+    """
+    key = make_key(story, PDF_TEMPLATE_VERSION, watermark_text, logo_path)
+    cached = await asyncio.to_thread(pdf_cache.open, key)
+    if cached is not None:
+        return cached
+
+    # Identical concurrent downloads share one render. It runs as its own task,
+    # so a client that disconnects does not cancel it for the others.
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.create_task(_render(key, story, watermark_text, logo_path))
+        _in_flight[key] = task
+        task.add_done_callback(lambda t: _render_done(key, t))
+    return io.BytesIO(await asyncio.shield(task))
+
+
+async def _render(key: str, story: str, watermark_text: str, logo_path) -> bytes:
+    loop = asyncio.get_running_loop()
+    try:
+        pdf_bytes = await loop.run_in_executor(
+            get_pool(), create_urdu_pdf_weasyprint, story, watermark_text, logo_path
+        )
+    except BrokenProcessPool:
+        # A crashed worker poisons the whole pool; start a fresh one next time
+        shutdown_pool()
+        raise
+    await asyncio.to_thread(pdf_cache.put, key, pdf_bytes)
+    return pdf_bytes
+
+
+def pdf_chunks(f: BinaryIO, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """Reads and closes a file returned by render_story_pdf (for a StreamingResponse)."""
+    with f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def _render_done(key: str, task: asyncio.Task):
+    del _in_flight[key]
+    # Every requester may have gone away; mark the exception as retrieved
+    if not task.cancelled():
+        task.exception()
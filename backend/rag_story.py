@@ -1,15 +1,17 @@
 # rag_story_router.py
+import asyncio
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 import pandas as pd
 import numpy as np
-import ast
 from dotenv import load_dotenv
 import os
-from sklearn.metrics.pairwise import cosine_similarity
 from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.prompts import PromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
+from story_index import load_embedding_matrix, load_or_build_index
+from cache import LRUCache, TTLCache, DiskCache, make_key
+from streaming import sse_event, sse_response, stream_llm
 
 # Setup
 load_dotenv()
@@ -21,16 +23,47 @@ router = APIRouter()
 # Pydantic input schema
 class QueryRequest(BaseModel):
     query: str
+    fresh: bool = False  # skip the story cache and generate a new variation
 
 # Load embedded data and embedder only once
 EMBEDDED_CSV = "Data/embedded_prompts.csv"
-df = pd.read_csv(EMBEDDED_CSV)
-df['prompt_embeddings'] = df['prompt_embeddings'].apply(ast.literal_eval)
+EMBEDDED_NPY = "Data/embedded_prompts.npy"  # normalised float32 matrix, built from the CSV on first run
+stories = pd.read_csv(EMBEDDED_CSV, usecols=["Story"])["Story"].tolist()
+embedding_matrix = load_embedding_matrix(EMBEDDED_CSV, EMBEDDED_NPY)
+
+# Vector index: "exact" (brute-force scan), "ivf" or "hnsw" (approximate)
+RAG_INDEX = os.getenv("RAG_INDEX", "exact")
+RAG_INDEX_OPTIONS = {
+    "exact": {},
+    "ivf": {"nprobe": int(os.getenv("RAG_INDEX_NPROBE", "8"))},
+    "hnsw": {"ef": int(os.getenv("RAG_INDEX_EF", "64"))},
+}
+RAG_INDEX_PATHS = {"ivf": "Data/embedded_prompts.ivf.npz", "hnsw": "Data/embedded_prompts.hnsw.bin"}
+vector_index = load_or_build_index(RAG_INDEX, embedding_matrix, RAG_INDEX_PATHS.get(RAG_INDEX),
+                                   **RAG_INDEX_OPTIONS.get(RAG_INDEX, {}))
 embedder = HuggingFaceEmbeddings(model_name="BAAI/bge-small-en-v1.5")
 
 # LLM setup
 llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0.9)
 
+# --- Caches ---
+# Level 1: normalised query -> embedding (deterministic, so always safe to reuse)
+embedding_cache = LRUCache(maxsize=int(os.getenv("RAG_EMBEDDING_CACHE_SIZE", "2048")))
+
+# Level 2: (query, context id, template version) -> generated story
+# RAG_STORY_CACHE is "off" (default: every request gets a new story), "memory" or "disk"
+RAG_STORY_CACHE = os.getenv("RAG_STORY_CACHE", "off")
+RAG_STORY_CACHE_TTL = float(os.getenv("RAG_STORY_CACHE_TTL", "86400"))
+if RAG_STORY_CACHE == "disk":
+    story_cache = DiskCache("cache/rag_stories", ttl=RAG_STORY_CACHE_TTL)
+elif RAG_STORY_CACHE == "memory":
+    story_cache = TTLCache(maxsize=512, ttl=RAG_STORY_CACHE_TTL)
+else:
+    story_cache = None
+
+# Bump whenever prompt_template changes so stale stories are not served
+PROMPT_TEMPLATE_VERSION = 1
+
 # Prompt template
 prompt_template = PromptTemplate(
     template="""
@@ -58,21 +91,101 @@ prompt_template = PromptTemplate(
 )
 
 
+def normalize_query(query: str) -> str:
+    return " ".join(query.split()).casefold()
+
+
+def embed_query_cached(query: str) -> np.ndarray:
+    key = normalize_query(query)
+    query_embedding = embedding_cache.get(key)
+    if query_embedding is None:
+        query_embedding = np.asarray(embedder.embed_query(query), dtype=np.float32)
+        embedding_cache.set(key, query_embedding)
+    return query_embedding
+
+
+def find_best_story_match(query: str) -> tuple[int, str]:
+    """Returns (row id, story) of the closest context story."""
+    indices, _ = vector_index.search(embed_query_cached(query)[None, :], k=1)
+    top_index = int(indices[0][0])
+    if top_index < 0:
+        # Approximate indexes pad with -1 when they hold no vectors at all
+        raise LookupError("The story index is empty")
+    return top_index, stories[top_index]
+
+
 def find_best_story_context(query: str):
-    query_embedding = embedder.embed_query(query)
-    similarities = cosine_similarity([query_embedding], df['prompt_embeddings'].tolist())[0]
-    top_index = np.argmax(similarities)
-    return df.iloc[top_index]['Story']
+    return find_best_story_match(query)[1]
+
 
+def find_best_story_contexts(queries: list[str], k: int = 1) -> list[list[str]]:
+    """Batched retrieval: the k best context stories for every query."""
+    query_embeddings = np.asarray(embedder.embed_documents(queries), dtype=np.float32)
+    indices, _ = vector_index.search(query_embeddings, k=k)
+    return [[stories[i] for i in row if i >= 0] for row in indices]
+
+
+
+async def prepare_story_prompt(data: QueryRequest) -> tuple[str, str, str | None]:
+    """Returns (cache key, formatted prompt, cached story or None)."""
+    # Embedding + vector search are CPU work, keep them off the event loop
+    context_id, context_story = await asyncio.to_thread(find_best_story_match, data.query)
+    cache_key = make_key(normalize_query(data.query), context_id, PROMPT_TEMPLATE_VERSION)
+    cached = None
+    if story_cache is not None and not data.fresh:
+        # DiskCache reads and unpickles: off the event loop like the search
+        cached = await asyncio.to_thread(story_cache.get, cache_key)
+    formatted_prompt = prompt_template.format(query=data.query, context=context_story)
+    return cache_key, formatted_prompt, cached
 
 
 @router.post("/chat")
 async def generate_story(data: QueryRequest):
     try:
-        context_story = find_best_story_context(data.query)
-        formatted_prompt = prompt_template.format(query=data.query, context=context_story)
-        response = llm.invoke(formatted_prompt)
+        cache_key, formatted_prompt, cached = await prepare_story_prompt(data)
+        if cached is not None:
+            return cached
 
+        response = await llm.ainvoke(formatted_prompt)
+
+        if story_cache is not None:
+            await asyncio.to_thread(story_cache.set, cache_key, response.content)
         return response.content
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating story: {str(e)}")
+
+
+@router.post("/chat/stream")
+async def stream_story(data: QueryRequest):
+    """Same as /chat, but streams the story as server-sent events."""
+    try:
+        cache_key, formatted_prompt, cached = await prepare_story_prompt(data)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating story: {str(e)}")
+
+    async def events():
+        if cached is not None:
+            yield sse_event(cached)
+            yield sse_event(cached, event="done")
+            return
+        story = ""
+        try:
+            async for text in stream_llm(llm, formatted_prompt):
+                story += text
+                yield sse_event(text)
+        except Exception as e:
+            yield sse_event(f"Error generating story: {str(e)}", event="error")
+            return
+        if story_cache is not None:
+            await asyncio.to_thread(story_cache.set, cache_key, story)
+        yield sse_event(story, event="done")
+
+    return sse_response(events())
+
+
+@router.get("/cache_stats")
+async def cache_stats():
+    return {
+        "embeddings": embedding_cache.stats(),
+        "stories": story_cache.stats() if story_cache is not None else None,
+    }
@@ -0,0 +1,437 @@
+# story_index.py
+"""
+Embedding matrix for the RAG story corpus.
+
+The prompt embeddings from ``Data/embedded_prompts.csv`` are parsed once,
+L2-normalised and saved as a contiguous float32 ``.npy`` file next to the
+CSV. At startup the ``.npy`` is memory-mapped, so retrieval is a single
+matrix-vector product (cosine similarity == dot product on unit vectors)
+followed by an ``argpartition`` top-k.
+
+On top of the matrix sits a pluggable vector index: ``ExactIndex`` (the
+brute-force scan, always available and used as the recall baseline),
+``IVFIndex`` (inverted lists over k-means centroids, pure numpy) and
+``HNSWIndex`` (needs the optional ``hnswlib`` package). All of them support
+incremental ``add``, ``save``/``load`` and a recall/latency knob.
+
+Run ``python story_index.py`` to benchmark against the old
+CSV + ``ast.literal_eval`` + sklearn ``cosine_similarity`` path, or
+``python story_index.py --ann`` to compare recall and latency of the indexes.
+"""
+import ast
+import hashlib
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+EMBEDDING_COLUMN = "prompt_embeddings"
+
+
+def default_npy_path(csv_path: str) -> str:
+    return os.path.splitext(csv_path)[0] + ".npy"
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def build_embedding_matrix(csv_path: str, npy_path: str | None = None) -> str:
+    """Parses the CSV embedding column once and writes the normalised .npy."""
+    npy_path = npy_path or default_npy_path(csv_path)
+    column = pd.read_csv(csv_path, usecols=[EMBEDDING_COLUMN])[EMBEDDING_COLUMN]
+    matrix = normalize_rows(np.array([ast.literal_eval(v) for v in column], dtype=np.float32))
+
+    # Write to a temp file and rename so a crash never leaves a half-written matrix
+    tmp_path = npy_path + ".tmp.npy"
+    np.save(tmp_path, matrix)
+    os.replace(tmp_path, npy_path)
+    print(f"✅ Built {npy_path} {matrix.shape} from {csv_path}")
+    return npy_path
+
+
+def load_embedding_matrix(csv_path: str, npy_path: str | None = None) -> np.ndarray:
+    """
+    Memory-maps the float32 matrix, (re)building it first when the .npy is
+    missing or older than the CSV.
+    """
+    npy_path = npy_path or default_npy_path(csv_path)
+    if not os.path.exists(npy_path) or (
+        os.path.exists(csv_path) and os.path.getmtime(npy_path) < os.path.getmtime(csv_path)
+    ):
+        build_embedding_matrix(csv_path, npy_path)
+    return np.load(npy_path, mmap_mode="r")
+
+
+def matrix_fingerprint(matrix: np.ndarray) -> str:
+    """SHA-256 of the matrix contents; a saved index is only reused for the same matrix."""
+    digest = hashlib.sha256(str(matrix.shape).encode())
+    for start in range(0, matrix.shape[0], 4096):
+        digest.update(np.ascontiguousarray(matrix[start:start + 4096], dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+def top_k(matrix: np.ndarray, query: np.ndarray, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+    """Returns (indices, scores) of the k best rows for one query, best first."""
+    indices, scores = top_k_batch(matrix, np.asarray(query)[None, :], k)
+    return indices[0], scores[0]
+
+
+def top_k_batch(matrix: np.ndarray, queries: np.ndarray, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Scores many queries at once with a single matrix product.
+    Returns (indices, scores), both shaped (num_queries, k), best first.
+    """
+    queries = normalize_rows(np.atleast_2d(queries))
+    scores = queries @ matrix.T
+    k = min(k, scores.shape[1])
+
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(k), (scores.shape[0], k))
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1)
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+
+# --- Vector indexes ---
+class ExactIndex:
+    """Brute-force scan over the whole matrix."""
+
+    kind = "exact"
+
+    def __init__(self, vectors: np.ndarray | None = None, dim: int | None = None):
+        # Keeps a memory-mapped matrix as-is until the first insert
+        if vectors is not None:
+            self.vectors = vectors
+        else:
+            self.vectors = np.empty((0, dim or 0), dtype=np.float32)
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def add(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = normalize_rows(np.atleast_2d(vectors))
+        ids = np.arange(len(self), len(self) + len(vectors))
+        self.vectors = np.concatenate([np.asarray(self.vectors), vectors])
+        return ids
+
+    def search(self, queries: np.ndarray, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        return top_k_batch(self.vectors, queries, k)
+
+    def save(self, path: str):
+        np.save(path, np.asarray(self.vectors))
+
+    @classmethod
+    def load(cls, path: str, **options) -> "ExactIndex":
+        return cls(np.load(path, mmap_mode="r"))
+
+
+class IVFIndex:
+    """
+    Inverted-file index: vectors are bucketed by their nearest k-means
+    centroid and a query only scans the ``nprobe`` closest buckets (more
+    when those hold fewer than k vectors). Raising ``nprobe`` trades latency
+    for recall (nprobe == nlist is exact).
+    """
+
+    kind = "ivf"
+
+    def __init__(self, dim: int, nlist: int | None = None, nprobe: int = 8):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids: np.ndarray | None = None
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.assignments = np.empty(0, dtype=np.int64)
+        self.lists: list[np.ndarray] = []
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def train(self, vectors: np.ndarray, iterations: int = 10, seed: int = 0):
+        """Spherical k-means on (a sample of) the corpus."""
+        vectors = normalize_rows(vectors)
+        nlist = self.nlist or max(1, int(np.sqrt(len(vectors))))
+        nlist = min(nlist, len(vectors))
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(len(vectors), min(len(vectors), nlist * 256), replace=False)]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = sample[assign == c]
+                # Re-seed empty clusters from a random sample point
+                centroids[c] = members.sum(axis=0) if len(members) else sample[rng.integers(len(sample))]
+            centroids = normalize_rows(centroids)
+
+        self.nlist = nlist
+        self.centroids = centroids
+        self.lists = [np.empty(0, dtype=np.int64) for _ in range(nlist)]
+
+    def add(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = normalize_rows(np.atleast_2d(vectors))
+        if self.centroids is None:
+            self.train(vectors)
+        ids = np.arange(len(self), len(self) + len(vectors))
+        assign = np.argmax(vectors @ self.centroids.T, axis=1)
+        self.vectors = np.concatenate([self.vectors, vectors])
+        self.assignments = np.concatenate([self.assignments, assign])
+        for c in np.unique(assign):
+            self.lists[c] = np.concatenate([self.lists[c], ids[assign == c]])
+        return ids
+
+    def search(self, queries: np.ndarray, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        queries = normalize_rows(np.atleast_2d(queries))
+        nprobe = min(self.nprobe, self.nlist)
+        order = np.argsort(-(queries @ self.centroids.T), axis=1)
+
+        # -1 / -inf only pad rows when the whole index holds fewer than k vectors
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for qi, ranked in enumerate(order):
+            probed = [self.lists[c] for c in ranked[:nprobe]]
+            found = sum(len(ids) for ids in probed)
+            # Keep probing the next closest buckets until there are k candidates
+            for c in ranked[nprobe:]:
+                if found >= k:
+                    break
+                probed.append(self.lists[c])
+                found += len(self.lists[c])
+            candidates = np.concatenate(probed)
+            if not len(candidates):
+                continue
+            local, local_scores = top_k_batch(self.vectors[candidates], queries[qi:qi + 1], k)
+            n = local.shape[1]
+            indices[qi, :n] = candidates[local[0]]
+            scores[qi, :n] = local_scores[0]
+        return indices, scores
+
+    def save(self, path: str):
+        np.savez(path, centroids=self.centroids, vectors=self.vectors,
+                 assignments=self.assignments, nprobe=self.nprobe)
+
+    @classmethod
+    def load(cls, path: str, nprobe: int | None = None, **options) -> "IVFIndex":
+        with np.load(path, allow_pickle=False) as data:
+            index = cls(data["vectors"].shape[1], len(data["centroids"]),
+                        nprobe if nprobe is not None else int(data["nprobe"]))
+            index.centroids = data["centroids"]
+            index.vectors = data["vectors"]
+            index.assignments = data["assignments"]
+        index.lists = [np.flatnonzero(index.assignments == c) for c in range(index.nlist)]
+        return index
+
+
+class HNSWIndex:
+    """
+    HNSW graph index backed by the optional ``hnswlib`` package. ``ef`` is
+    the search-time beam width: higher means better recall, slower queries.
+    """
+
+    kind = "hnsw"
+
+    def __init__(self, dim: int, ef: int = 64, M: int = 16, ef_construction: int = 200,
+                 capacity: int = 1024):
+        import hnswlib
+
+        self.dim = dim
+        self._index = hnswlib.Index(space="ip", dim=dim)
+        self._index.init_index(max_elements=capacity, ef_construction=ef_construction, M=M)
+        self.ef = ef
+
+    @property
+    def ef(self) -> int:
+        return self._ef
+
+    @ef.setter
+    def ef(self, value: int):
+        self._ef = value
+        self._index.set_ef(value)
+
+    def __len__(self):
+        return self._index.get_current_count()
+
+    def add(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = normalize_rows(np.atleast_2d(vectors))
+        ids = np.arange(len(self), len(self) + len(vectors))
+        needed = len(self) + len(vectors)
+        if needed > self._index.get_max_elements():
+            self._index.resize_index(max(needed, 2 * self._index.get_max_elements()))
+        self._index.add_items(vectors, ids)
+        return ids
+
+    def search(self, queries: np.ndarray, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        queries = normalize_rows(np.atleast_2d(queries))
+        k = min(k, len(self))
+        self._index.set_ef(max(self._ef, k))
+        labels, distances = self._index.knn_query(queries, k=k)
+        # hnswlib's "ip" space reports 1 - dot product
+        return labels.astype(np.int64), (1.0 - distances).astype(np.float32)
+
+    def save(self, path: str):
+        self._index.save_index(path)
+
+    @classmethod
+    def load(cls, path: str, ef: int = 64, **options) -> "HNSWIndex":
+        import hnswlib
+
+        index = cls.__new__(cls)
+        raw = hnswlib.Index(space="ip", dim=options["dim"])
+        raw.load_index(path)
+        index.dim = options["dim"]
+        index._index = raw
+        index.ef = ef
+        return index
+
+
+INDEX_TYPES = {cls.kind: cls for cls in (ExactIndex, IVFIndex, HNSWIndex)}
+
+
+def build_index(kind: str, matrix: np.ndarray, **options):
+    """Builds an index of the requested kind over ``matrix``."""
+    if kind == ExactIndex.kind:
+        return ExactIndex(matrix)
+    index = INDEX_TYPES[kind](matrix.shape[1], **options)
+    if kind == IVFIndex.kind:
+        index.train(np.asarray(matrix))
+    index.add(np.asarray(matrix))
+    return index
+
+
+def load_or_build_index(kind: str, matrix: np.ndarray, path: str | None = None, **options):
+    """
+    Loads a saved approximate index when it was built from this matrix
+    (same SHA-256, kept in ``<path>.sha256``), otherwise builds and saves a
+    new one. Falls back to the exact scan when the backend is unavailable
+    (e.g. ``hnswlib`` is not installed).
+    """
+    if kind == ExactIndex.kind:
+        return ExactIndex(matrix)
+    try:
+        fingerprint = matrix_fingerprint(matrix)
+        fingerprint_path = f"{path}.sha256"
+        if path and os.path.exists(path):
+            saved = open(fingerprint_path).read().strip() if os.path.exists(fingerprint_path) else None
+            if saved == fingerprint:
+                return INDEX_TYPES[kind].load(path, dim=matrix.shape[1], **options)
+            print(f"⚠️ {path} was built from a different embedding matrix, rebuilding")
+        index = build_index(kind, matrix, **options)
+        if path:
+            index.save(path)
+            with open(fingerprint_path, "w") as f:
+                f.write(fingerprint)
+        return index
+    except ImportError as e:
+        print(f"⚠️ {kind} index unavailable ({e}), falling back to exact search")
+        return ExactIndex(matrix)
+
+
+def recall_at_k(index, baseline: ExactIndex, queries: np.ndarray, k: int = 10) -> float:
+    """Fraction of the exact top-k neighbours that ``index`` also returns."""
+    found, _ = index.search(queries, k)
+    expected, _ = baseline.search(queries, k)
+    hits = sum(len(set(f) & set(e)) for f, e in zip(found.tolist(), expected.tolist()))
+    return hits / expected.size
+
+
+# --- Benchmark ---
+def _benchmark(csv_path: str | None, rows: int, dim: int, num_queries: int):
+    import tempfile
+    from sklearn.metrics.pairwise import cosine_similarity
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        if not csv_path:
+            csv_path = os.path.join(tmp, "embedded_prompts.csv")
+            vectors = rng.standard_normal((rows, dim)).astype(np.float32)
+            pd.DataFrame({
+                "Story": [f"story {i}" for i in range(rows)],
+                EMBEDDING_COLUMN: [str(v.tolist()) for v in vectors],
+            }).to_csv(csv_path, index=False)
+        npy_path = os.path.join(tmp, "prompt_embeddings.npy")
+
+        start = time.perf_counter()
+        df = pd.read_csv(csv_path)
+        df[EMBEDDING_COLUMN] = df[EMBEDDING_COLUMN].apply(ast.literal_eval)
+        csv_load = time.perf_counter() - start
+
+        build_embedding_matrix(csv_path, npy_path)
+        start = time.perf_counter()
+        matrix = load_embedding_matrix(csv_path, npy_path)
+        npy_load = time.perf_counter() - start
+
+        queries = rng.standard_normal((num_queries, matrix.shape[1])).astype(np.float32)
+
+        start = time.perf_counter()
+        old_best = []
+        for q in queries:
+            similarities = cosine_similarity([q.tolist()], df[EMBEDDING_COLUMN].tolist())[0]
+            old_best.append(int(np.argmax(similarities)))
+        old_query = (time.perf_counter() - start) / num_queries
+
+        start = time.perf_counter()
+        new_best = [int(top_k(matrix, q, 1)[0][0]) for q in queries]
+        new_query = (time.perf_counter() - start) / num_queries
+
+        start = time.perf_counter()
+        top_k_batch(matrix, queries, 1)
+        batch_query = (time.perf_counter() - start) / num_queries
+
+    print(f"corpus: {matrix.shape[0]} x {matrix.shape[1]}, {num_queries} queries")
+    print(f"startup   csv+literal_eval: {csv_load * 1000:9.2f} ms | npy mmap: {npy_load * 1000:9.2f} ms")
+    print(f"per query cosine_similarity: {old_query * 1000:8.3f} ms | matvec top-k: {new_query * 1000:8.3f} ms"
+          f" | batched: {batch_query * 1000:8.3f} ms")
+    print(f"same top-1 for {sum(a == b for a, b in zip(old_best, new_best))}/{num_queries} queries")
+
+
+def _benchmark_ann(rows: int, dim: int, num_queries: int, k: int = 10):
+    # Clustered data, closer to real sentence embeddings than uniform noise
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((64, dim))
+    matrix = normalize_rows(centers[rng.integers(64, size=rows)] + 0.5 * rng.standard_normal((rows, dim)))
+    queries = normalize_rows(centers[rng.integers(64, size=num_queries)] + 0.5 * rng.standard_normal((num_queries, dim)))
+    exact = ExactIndex(matrix)
+
+    def timed(index):
+        start = time.perf_counter()
+        for q in queries:
+            index.search(q, k)
+        return (time.perf_counter() - start) / num_queries * 1000
+
+    print(f"corpus: {rows} x {dim}, {num_queries} queries, recall@{k}")
+    print(f"exact            {timed(exact):8.3f} ms/query  recall 1.000")
+    ivf = build_index("ivf", matrix)
+    for nprobe in (1, 4, 8, 16, 32):
+        ivf.nprobe = nprobe
+        print(f"ivf nprobe={nprobe:<4} {timed(ivf):8.3f} ms/query  recall {recall_at_k(ivf, exact, queries, k):.3f}")
+    try:
+        hnsw = build_index("hnsw", matrix)
+    except ImportError:
+        print("hnsw             skipped (hnswlib not installed)")
+        return
+    for ef in (16, 32, 64, 128):
+        hnsw.ef = ef
+        print(f"hnsw ef={ef:<7} {timed(hnsw):8.3f} ms/query  recall {recall_at_k(hnsw, exact, queries, k):.3f}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark CSV vs .npy story retrieval")
+    parser.add_argument("--csv", help="embedded_prompts.csv to use (default: synthetic corpus)")
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--ann", action="store_true", help="compare approximate indexes against exact search")
+    args = parser.parse_args()
+    if args.ann:
+        _benchmark_ann(args.rows, args.dim, args.queries)
+    else:
+        _benchmark(args.csv, args.rows, args.dim, args.queries)
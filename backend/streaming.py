@@ -0,0 +1,49 @@
+# streaming.py
+"""
+Server-sent-event helpers shared by the routers and main.py.
+
+Every event carries a JSON payload so multi-line Urdu text survives the
+line-based SSE framing. A stream is a series of ``chunk`` events followed by
+either ``done`` or ``error``.
+"""
+import json
+from typing import Any, AsyncIterator
+
+import httpx
+from fastapi.responses import StreamingResponse
+
+
+def sse_event(data: Any, event: str = "chunk") -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def sse_response(events: AsyncIterator[str]) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        # Stop proxies from buffering the stream into one response
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def stream_llm(llm, prompt: str) -> AsyncIterator[str]:
+    """Yields the text of each chunk from a LangChain chat model's ``astream``."""
+    async for chunk in llm.astream(prompt):
+        if chunk.content:
+            yield chunk.content
+
+
+async def iter_sse(response: httpx.Response) -> AsyncIterator[tuple[str, Any]]:
+    """Parses an SSE response body into (event, data) pairs."""
+    event, data = "message", []
+    async for line in response.aiter_lines():
+        if not line:
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
+    if data:
+        yield event, json.loads("\n".join(data))
@@ -0,0 +1,5 @@
+# The backend modules import each other by bare name (``from cache import ...``)
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
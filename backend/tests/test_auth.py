@@ -0,0 +1,129 @@
+# test_auth.py
+"""
+ClerkJWTVerifier against a local RSA key pair: tokens are signed here and
+the JWKS is served by an httpx.MockTransport standing in for Clerk.
+"""
+import asyncio
+import time
+
+import httpx
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import auth
+from auth import AuthError, ClerkJWTVerifier
+
+ISSUER = "https://clerk.example.test"
+CLIENT = "http://localhost:5173"
+
+
+def make_key(kid: str):
+    private = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    public = jwt.algorithms.RSAAlgorithm.to_jwk(private.public_key(), as_dict=True)
+    return private, {**public, "kid": kid, "alg": "RS256", "use": "sig"}
+
+
+KEY_A, JWK_A = make_key("key-a")
+KEY_B, JWK_B = make_key("key-b")
+
+
+def sign(private=KEY_A, kid="key-a", **claims) -> str:
+    now = int(time.time())
+    payload = {"sub": "user_123", "iss": ISSUER, "azp": CLIENT, "iat": now, "exp": now + 60, **claims}
+    return jwt.encode(payload, private, algorithm="RS256", headers={"kid": kid})
+
+
+class StubClerk:
+    """Serves whatever keys are in `keys` and counts the JWKS fetches."""
+    def __init__(self, *keys):
+        self.keys = list(keys)
+        self.fetches = 0
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.fetches += 1
+        return httpx.Response(200, json={"keys": self.keys})
+
+
+def verify(clerk: StubClerk, *tokens, **options):
+    """Verifies the tokens in order with one verifier; returns claims or the AuthError."""
+    async def run():
+        verifier = ClerkJWTVerifier(jwks_url="https://jwks.test/.well-known/jwks.json",
+                                    authorized_parties=[CLIENT], issuer=ISSUER, **options)
+        verifier._http = httpx.AsyncClient(transport=httpx.MockTransport(clerk.handler))
+        try:
+            await verifier.refresh_keys()
+            results = []
+            for token in tokens:
+                try:
+                    results.append(await verifier.verify(token))
+                except AuthError as e:
+                    results.append(e)
+            return results
+        finally:
+            await verifier._http.aclose()
+    return asyncio.run(run())
+
+
+def test_valid_token():
+    [claims] = verify(StubClerk(JWK_A), sign())
+    assert claims["sub"] == "user_123"
+
+
+def test_valid_token_is_memoized():
+    clerk = StubClerk(JWK_A)
+    token = sign()
+    first, second = verify(clerk, token, token)
+    assert first is second
+
+
+def test_expired_token():
+    now = int(time.time())
+    [error] = verify(StubClerk(JWK_A), sign(iat=now - 120, exp=now - 60))
+    assert isinstance(error, AuthError)
+
+
+def test_wrong_issuer():
+    [error] = verify(StubClerk(JWK_A), sign(iss="https://evil.example.test"))
+    assert isinstance(error, AuthError)
+
+
+def test_wrong_authorized_party():
+    [error] = verify(StubClerk(JWK_A), sign(azp="https://evil.example.test"))
+    assert isinstance(error, AuthError)
+
+
+def test_unknown_kid_refetches_jwks(monkeypatch):
+    monkeypatch.setattr(auth, "JWKS_MIN_REFRESH_GAP", 0.0)
+    # Clerk rotated to key B after the verifier loaded its keys
+    clerk = StubClerk(JWK_A)
+    original = clerk.handler
+
+    def rotating(request):
+        response = original(request)
+        clerk.keys = [JWK_A, JWK_B]
+        return response
+    clerk.handler = rotating
+
+    [claims] = verify(clerk, sign(KEY_B, kid="key-b"))
+    assert claims["sub"] == "user_123"
+    assert clerk.fetches == 2
+
+
+def test_unknown_kid_refetch_is_rate_limited():
+    clerk = StubClerk(JWK_A)
+    [error] = verify(clerk, sign(KEY_B, kid="key-b"))
+    assert isinstance(error, AuthError)
+    assert clerk.fetches == 1
+
+
+def test_bad_signature():
+    # Signed with key B but claims to be key A
+    [error] = verify(StubClerk(JWK_A, JWK_B), sign(KEY_B, kid="key-a"))
+    assert isinstance(error, AuthError)
+
+
+@pytest.mark.parametrize("token", ["not-a-jwt", ""])
+def test_malformed_token(token):
+    [error] = verify(StubClerk(JWK_A), token)
+    assert isinstance(error, AuthError)
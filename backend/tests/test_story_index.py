@@ -0,0 +1,82 @@
+# test_story_index.py
+"""Approximate indexes against the exact scan, and reuse of saved indexes."""
+import numpy as np
+import pytest
+
+import story_index
+from story_index import (ExactIndex, IVFIndex, build_index, load_or_build_index,
+                         normalize_rows, recall_at_k)
+
+ROWS, DIM, K = 2000, 64, 10
+
+
+def clustered(rows: int, seed: int) -> np.ndarray:
+    # Same shape of data as story_index._benchmark_ann
+    rng = np.random.default_rng(seed)
+    centers = np.random.default_rng(0).standard_normal((32, DIM))
+    return normalize_rows(centers[rng.integers(32, size=rows)] + 0.5 * rng.standard_normal((rows, DIM)))
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    return clustered(ROWS, seed=1), clustered(50, seed=2)
+
+
+def test_ivf_recall(corpus):
+    matrix, queries = corpus
+    index = build_index("ivf", matrix, nprobe=8)
+    assert recall_at_k(index, ExactIndex(matrix), queries, K) >= 0.9
+
+
+def test_ivf_full_probe_is_exact(corpus):
+    matrix, queries = corpus
+    index = build_index("ivf", matrix)
+    index.nprobe = index.nlist
+    assert recall_at_k(index, ExactIndex(matrix), queries, K) == 1.0
+
+
+def test_hnsw_recall(corpus):
+    pytest.importorskip("hnswlib")
+    matrix, queries = corpus
+    index = build_index("hnsw", matrix, ef=64)
+    assert recall_at_k(index, ExactIndex(matrix), queries, K) >= 0.95
+
+
+def test_ivf_never_returns_missing_ids(corpus):
+    matrix, queries = corpus
+    index = IVFIndex(DIM, nlist=40, nprobe=1)
+    index.train(matrix)
+    # Only a few vectors, so most buckets (and most single probes) are empty
+    index.add(matrix[:15])
+    indices, _ = index.search(queries, K)
+    assert (indices >= 0).all()
+
+
+def test_incremental_add_is_searchable(corpus):
+    matrix, _ = corpus
+    index = build_index("ivf", matrix[:1000])
+    ids = index.add(matrix[1000:1010])
+    found, _ = index.search(matrix[1000:1010], 1)
+    assert found[:, 0].tolist() == ids.tolist()
+
+
+@pytest.mark.parametrize("kind,name", [("ivf", "index.npz"), ("hnsw", "index.bin")])
+def test_saved_index_is_rebuilt_when_matrix_changes(corpus, tmp_path, monkeypatch, kind, name):
+    if kind == "hnsw":
+        pytest.importorskip("hnswlib")
+    matrix, _ = corpus
+    path = str(tmp_path / name)
+    load_or_build_index(kind, matrix, path)
+
+    # Same number of rows, different contents (e.g. an edited CSV)
+    edited = matrix.copy()
+    edited[0] = -matrix[0]
+    index = load_or_build_index(kind, edited, path)
+    found, _ = index.search(edited[:1], 1)
+    assert found[0, 0] == 0
+
+    # Unchanged matrix: the saved index is loaded, not rebuilt
+    def no_rebuild(*args, **kwargs):
+        raise AssertionError("index was rebuilt")
+    monkeypatch.setattr(story_index, "build_index", no_rebuild)
+    assert len(load_or_build_index(kind, edited, path)) == ROWS
@@ -0,0 +1,400 @@
+# upstream.py
+"""
+Shared async HTTP layer for the remote Colab/ngrok services (static video,
+fluid video and fine-tuned story generation).
+
+Each service is a pool of interchangeable instances (Colab sessions / GPU
+boxes), listed in a JSON config file that is re-read when it changes, so
+instances can be added or retired without a restart:
+
+    {"video_static": ["http://a.ngrok-free.app", "http://b.ngrok-free.app"],
+     "story_gen": {"instances": ["http://c.ngrok-free.app"]}}
+
+Every instance gets its own pooled ``httpx.AsyncClient`` with keep-alive.
+Requests go to the healthy instance with the fewest outstanding requests and
+retry with exponential backoff, moving to another instance where possible.
+Each instance has a circuit breaker: after ``failure_threshold`` consecutive
+failures it is skipped for ``open_seconds``, then a single trial request (or
+a successful health probe) decides whether it closes again. A background
+loop probes every instance's ``health_path``.
+
+Calls that must reach the instance holding some state (polling and
+downloading a video job) pass ``instance=`` to pin them; ``instance_url``
+tells which instance served a response. Nothing in here blocks the event loop.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+
+import httpx
+
+# Status codes that mean "the tunnel / Colab runtime hiccupped", worth retrying.
+RETRY_STATUSES = {502, 503, 504}
+
+# Errors raised before the request reached the server: always safe to retry,
+# even for non-idempotent calls such as POST /make_video.
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+# Circuit breaker states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+HEALTH_INTERVAL = float(os.environ.get("UPSTREAM_HEALTH_INTERVAL", "15"))
+RELOAD_INTERVAL = float(os.environ.get("UPSTREAM_RELOAD_INTERVAL", "5"))
+HEALTH_TIMEOUT = httpx.Timeout(5.0)
+
+
+class UpstreamUnavailable(httpx.ConnectError):
+    """No instance of the service can take a request right now (retryable like a connect error)."""
+
+
+@dataclass
+class UpstreamInstance:
+    url: str
+    client: httpx.AsyncClient
+    outstanding: int = 0
+    healthy: bool = True
+    state: str = CLOSED
+    failures: int = 0
+    opened_at: float = 0.0
+
+    def snapshot(self) -> dict:
+        return {"url": self.url, "outstanding": self.outstanding, "healthy": self.healthy,
+                "state": self.state, "failures": self.failures}
+
+
+@dataclass
+class UpstreamService:
+    name: str
+    timeout: httpx.Timeout = field(default_factory=lambda: httpx.Timeout(30.0, connect=10.0))
+    retries: int = 3
+    backoff: float = 1.0
+    max_connections: int = 20
+    max_keepalive: int = 10
+    health_path: str = "/docs"
+    failure_threshold: int = 3
+    open_seconds: float = 30.0
+    instances: dict[str, UpstreamInstance] = field(default_factory=dict)
+    # Instances outside the rotation that pinned requests still need (e.g. removed from config)
+    pinned: dict[str, UpstreamInstance] = field(default_factory=dict)
+
+
+class UpstreamClient:
+    """Registry of upstream services, each a pool of instances."""
+
+    def __init__(self, config_path: str | None = None):
+        self.config_path = config_path
+        self._config_mtime = None
+        self._services: dict[str, UpstreamService] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    # --- Registry ---
+    def register(self, name: str, urls: str | list[str] = (), **options) -> UpstreamService:
+        """Registers a service with its timeouts; ``urls`` are defaults until the config lists it."""
+        service = UpstreamService(name=name, **options)
+        self._services[name] = service
+        self.set_instances(name, [urls] if isinstance(urls, str) else list(urls))
+        return service
+
+    def _service(self, name: str) -> UpstreamService:
+        if name not in self._services:
+            raise KeyError(f"Unknown upstream service: {name}")
+        return self._services[name]
+
+    def _new_instance(self, service: UpstreamService, url: str) -> UpstreamInstance:
+        client = httpx.AsyncClient(
+            base_url=url,
+            timeout=service.timeout,
+            limits=httpx.Limits(
+                max_connections=service.max_connections,
+                max_keepalive_connections=service.max_keepalive,
+                keepalive_expiry=60.0,
+            ),
+            # ngrok free tunnels show an HTML interstitial without this header
+            headers={"ngrok-skip-browser-warning": "1"},
+        )
+        return UpstreamInstance(url=url, client=client)
+
+    def set_instances(self, name: str, urls: list[str]):
+        service = self._service(name)
+        urls = [u.rstrip("/") for u in urls if u]
+        current = service.instances
+        updated = {}
+        for url in urls:
+            updated[url] = current.get(url) or service.pinned.pop(url, None) or self._new_instance(service, url)
+        for url, instance in current.items():
+            if url not in updated:
+                # In-flight and pinned requests may still use it; closed once idle
+                service.pinned[url] = instance
+        if set(updated) != set(current):
+            print(f"🔀 [{name}] instances: {', '.join(updated) or '(none)'}")
+        service.instances = updated
+
+    def load_config(self) -> bool:
+        """(Re)reads the config file if it changed; returns True when it was applied."""
+        if not self.config_path:
+            return False
+        try:
+            mtime = os.stat(self.config_path).st_mtime
+        except OSError:
+            return False
+        if mtime == self._config_mtime:
+            return False
+        try:
+            with open(self.config_path, encoding="utf-8") as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            # Keep the current instances; a half-written file is retried next time
+            print(f"⚠️ Could not read {self.config_path}: {e}")
+            return False
+        self._config_mtime = mtime
+
+        for name, entry in config.items():
+            if name not in self._services:
+                print(f"⚠️ {self.config_path}: unknown upstream service {name!r}")
+                continue
+            urls = entry.get("instances", []) if isinstance(entry, dict) else entry
+            if isinstance(urls, str):
+                urls = [urls]
+            if not isinstance(urls, list) or not all(isinstance(u, str) for u in urls):
+                print(f"⚠️ {self.config_path}: instances of {name!r} must be a URL or a list of URLs")
+                continue
+            self.set_instances(name, urls)
+        return True
+
+    def snapshot(self) -> dict:
+        return {name: [i.snapshot() for i in service.instances.values()]
+                for name, service in self._services.items()}
+
+    @staticmethod
+    def instance_url(resp: httpx.Response) -> str:
+        """The instance (origin) that served ``resp``, for pinning follow-up calls."""
+        url = resp.request.url
+        return f"{url.scheme}://{url.netloc.decode()}"
+
+    # --- Routing & circuit breaking ---
+    def _available(self, service: UpstreamService, instance: UpstreamInstance) -> bool:
+        if not instance.healthy:
+            return False
+        if instance.state != CLOSED:
+            # One trial per cool-down, so a trial that never reports back cannot wedge it
+            return time.monotonic() - instance.opened_at >= service.open_seconds
+        return True
+
+    def _pick(self, service: UpstreamService, tried: set[str], pinned: str | None) -> UpstreamInstance:
+        if pinned:
+            pinned = pinned.rstrip("/")
+            instance = service.instances.get(pinned) or service.pinned.get(pinned)
+            if instance is None:
+                instance = service.pinned[pinned] = self._new_instance(service, pinned)
+            return instance
+
+        candidates = [i for i in service.instances.values() if self._available(service, i)]
+        # Prefer an instance this request has not failed on yet
+        fresh = [i for i in candidates if i.url not in tried]
+        candidates = fresh or candidates
+        if not candidates:
+            raise UpstreamUnavailable(f"No available instance for {service.name}")
+
+        least = min(i.outstanding for i in candidates)
+        instance = random.choice([i for i in candidates if i.outstanding == least])
+        if instance.state != CLOSED:
+            instance.state = HALF_OPEN
+            instance.opened_at = time.monotonic()
+            print(f"🟡 [{service.name}] {instance.url} half-open, sending a trial request")
+        return instance
+
+    def _record(self, service: UpstreamService, instance: UpstreamInstance, ok: bool):
+        if ok:
+            if instance.state != CLOSED:
+                print(f"🟢 [{service.name}] {instance.url} recovered, circuit closed")
+            instance.state = CLOSED
+            instance.failures = 0
+            return
+        instance.failures += 1
+        if instance.state == HALF_OPEN or (instance.state == CLOSED
+                                           and instance.failures >= service.failure_threshold):
+            instance.state = OPEN
+            instance.opened_at = time.monotonic()
+            print(f"🔴 [{service.name}] {instance.url} circuit open after {instance.failures} failure(s)")
+
+    # --- Requests ---
+    def _should_retry(self, method: str, error: Exception | None, status: int | None) -> bool:
+        if isinstance(error, CONNECT_ERRORS):
+            return True
+        if method.upper() not in IDEMPOTENT_METHODS:
+            return False
+        return isinstance(error, httpx.TransportError) or status in RETRY_STATUSES
+
+    async def _sleep_backoff(self, service: UpstreamService, attempt: int):
+        delay = service.backoff * (2 ** attempt)
+        await asyncio.sleep(delay + random.uniform(0, delay / 2))
+
+    async def request(self, name: str, method: str, path: str, instance: str | None = None,
+                      **kwargs) -> httpx.Response:
+        """
+        Sends a request to an instance of ``name`` (or to ``instance``) and
+        returns the response once it is not a retryable failure. Raises
+        ``httpx.HTTPStatusError`` for error statuses.
+        """
+        service = self._service(name)
+        tried: set[str] = set()
+        last_error = None
+
+        for attempt in range(service.retries + 1):
+            try:
+                target = self._pick(service, tried, instance)
+            except UpstreamUnavailable as e:
+                last_error = e
+                if attempt < service.retries:
+                    await self._sleep_backoff(service, attempt)
+                    continue
+                raise
+            tried.add(target.url)
+            target.outstanding += 1
+            try:
+                resp = await target.client.request(method, path, **kwargs)
+            except httpx.TransportError as e:
+                last_error = e
+                self._record(service, target, ok=False)
+                if attempt < service.retries and self._should_retry(method, e, None):
+                    print(f"[{name}] {method} {target.url}{path} failed ({e!r}), retrying…")
+                    await self._sleep_backoff(service, attempt)
+                    continue
+                raise
+            finally:
+                target.outstanding -= 1
+
+            self._record(service, target, ok=resp.status_code not in RETRY_STATUSES)
+            if attempt < service.retries and self._should_retry(method, None, resp.status_code):
+                print(f"[{name}] {method} {target.url}{path} returned {resp.status_code}, retrying…")
+                await self._sleep_backoff(service, attempt)
+                continue
+
+            resp.raise_for_status()
+            return resp
+
+        raise last_error
+
+    @asynccontextmanager
+    async def stream(self, name: str, method: str, path: str, instance: str | None = None, **kwargs):
+        """
+        Like ``request`` but yields a streaming response; retries only apply
+        while opening the stream, never once the body has started flowing.
+        """
+        service = self._service(name)
+        tried: set[str] = set()
+
+        for attempt in range(service.retries + 1):
+            try:
+                target = self._pick(service, tried, instance)
+            except UpstreamUnavailable:
+                if attempt < service.retries:
+                    await self._sleep_backoff(service, attempt)
+                    continue
+                raise
+            tried.add(target.url)
+            target.outstanding += 1
+            try:
+                req = target.client.build_request(method, path, **kwargs)
+                resp = await target.client.send(req, stream=True)
+            except httpx.TransportError as e:
+                target.outstanding -= 1
+                self._record(service, target, ok=False)
+                if attempt < service.retries and self._should_retry(method, e, None):
+                    print(f"[{name}] {method} {target.url}{path} failed ({e!r}), retrying…")
+                    await self._sleep_backoff(service, attempt)
+                    continue
+                raise
+
+            self._record(service, target, ok=resp.status_code not in RETRY_STATUSES)
+            if attempt < service.retries and self._should_retry(method, None, resp.status_code):
+                await resp.aclose()
+                target.outstanding -= 1
+                print(f"[{name}] {method} {target.url}{path} returned {resp.status_code}, retrying…")
+                await self._sleep_backoff(service, attempt)
+                continue
+            break
+
+        try:
+            if resp.is_error:
+                await resp.aread()
+                resp.raise_for_status()
+            yield resp
+        finally:
+            await resp.aclose()
+            target.outstanding -= 1
+
+    async def get(self, name: str, path: str, **kwargs) -> httpx.Response:
+        return await self.request(name, "GET", path, **kwargs)
+
+    async def post(self, name: str, path: str, **kwargs) -> httpx.Response:
+        return await self.request(name, "POST", path, **kwargs)
+
+    # --- Background health probes & config reload ---
+    async def _probe(self, service: UpstreamService, instance: UpstreamInstance):
+        try:
+            resp = await instance.client.get(service.health_path, timeout=HEALTH_TIMEOUT)
+            healthy = resp.status_code < 400
+        except httpx.HTTPError:
+            healthy = False
+        if healthy != instance.healthy:
+            print(f"{'💚' if healthy else '💔'} [{service.name}] {instance.url} "
+                  f"{'healthy' if healthy else 'failed its health check'}")
+        instance.healthy = healthy
+        # A passing probe after the cool-down doubles as the half-open trial
+        if (healthy and instance.state != CLOSED
+                and time.monotonic() - instance.opened_at >= service.open_seconds):
+            self._record(service, instance, ok=True)
+
+    async def check_health(self):
+        probes = [self._probe(service, instance)
+                  for service in self._services.values()
+                  for instance in list(service.instances.values())]
+        await asyncio.gather(*probes)
+
+        # Close retired instances once nothing uses them any more
+        for service in self._services.values():
+            for url, instance in list(service.pinned.items()):
+                if instance.outstanding == 0:
+                    await instance.client.aclose()
+                    del service.pinned[url]
+
+    async def _health_loop(self, interval: float):
+        while True:
+            try:
+                await self.check_health()
+            except Exception as e:
+                print(f"⚠️ Upstream health check failed: {e}")
+            await asyncio.sleep(interval)
+
+    async def _reload_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.load_config()
+
+    async def start(self, health_interval: float = HEALTH_INTERVAL,
+                    reload_interval: float = RELOAD_INTERVAL):
+        self.load_config()
+        self._tasks = [
+            asyncio.create_task(self._health_loop(health_interval)),
+            asyncio.create_task(self._reload_loop(reload_interval)),
+        ]
+
+    async def aclose(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        for service in self._services.values():
+            for instance in [*service.instances.values(), *service.pinned.values()]:
+                await instance.client.aclose()
+            service.instances.clear()
+            service.pinned.clear()
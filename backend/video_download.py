@@ -0,0 +1,136 @@
+# video_download.py
+"""
+Shared download stage for finished videos.
+
+The MP4 is streamed in large chunks straight into ``<dest>.part`` (never held
+in memory). If the connection drops, the download resumes from the bytes
+already on disk with an HTTP ``Range`` request; this also works after a
+backend restart, since video jobs resume with their upstream job id. Once
+complete, the size (Content-Length / Content-Range) and the SHA-256 (the
+``X-Content-SHA256`` header sent by the Colab servers) are verified, and the
+file is atomically renamed to ``dest``.
+"""
+import asyncio
+import hashlib
+import os
+import re
+from pathlib import Path
+
+import httpx
+
+from upstream import UpstreamClient
+
+CHUNK_SIZE = 1 << 20  # 1 MiB
+MAX_RESUMES = int(os.environ.get("VIDEO_DOWNLOAD_RESUMES", "5"))
+RESUME_BACKOFF = 2.0
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+
+class DownloadError(Exception):
+    pass
+
+
+def _hash_file(path: Path) -> "hashlib._Hash":
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest
+
+
+def _open_part(part: Path, offset: int):
+    f = open(part, "r+b" if offset else "wb", buffering=CHUNK_SIZE)
+    f.seek(offset)
+    f.truncate()
+    return f
+
+
+def _write_chunk(f, digest: "hashlib._Hash", chunk: bytes):
+    f.write(chunk)
+    digest.update(chunk)
+
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _total_size(resp: httpx.Response) -> int | None:
+    if resp.status_code == 206:
+        match = CONTENT_RANGE.match(resp.headers.get("Content-Range", ""))
+        if match and match.group(3) != "*":
+            return int(match.group(3))
+        return None
+    length = resp.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+
+async def download_video(upstream: UpstreamClient, service: str, path: str, dest: Path,
+                         timeout: httpx.Timeout | None = None,
+                         max_resumes: int = MAX_RESUMES, instance: str | None = None) -> Path:
+    """
+    Downloads ``service``'s ``path`` to ``dest`` and returns ``dest``. Pass
+    ``instance`` when only that upstream instance has the file.
+    """
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    part = dest.with_name(dest.name + ".part")
+
+    # Pick up a partial file left by an earlier attempt or process
+    offset = part.stat().st_size if part.exists() else 0
+    digest = await asyncio.to_thread(_hash_file, part) if offset else hashlib.sha256()
+    total = expected_sha = None
+    failures = 0
+
+    while True:
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            async with upstream.stream(service, "GET", path, headers=headers,
+                                       timeout=timeout, instance=instance) as resp:
+                if offset and resp.status_code != 206:
+                    # Range not honoured: start over from the first byte
+                    print(f"[{service}] {path}: server ignored Range, restarting download")
+                    offset, digest = 0, hashlib.sha256()
+                total = _total_size(resp) or total
+                expected_sha = resp.headers.get("X-Content-SHA256") or expected_sha
+
+                # Disk writes, hashing and fsync run in a worker thread, off the loop
+                f = await asyncio.to_thread(_open_part, part, offset)
+                try:
+                    async for chunk in resp.aiter_bytes(CHUNK_SIZE):
+                        await asyncio.to_thread(_write_chunk, f, digest, chunk)
+                        offset += len(chunk)
+                    await asyncio.to_thread(_sync, f)
+                finally:
+                    await asyncio.to_thread(f.close)
+        except httpx.HTTPStatusError as e:
+            # 416: everything was already on disk before the connection dropped
+            if e.response.status_code != 416 or not offset:
+                raise
+        except httpx.TransportError as e:
+            failures += 1
+            if failures > max_resumes:
+                raise DownloadError(f"Download of {path} failed after {max_resumes} resumes: {e!r}")
+            print(f"[{service}] {path}: connection lost at {offset} bytes ({e!r}), resuming…")
+            await asyncio.sleep(RESUME_BACKOFF * failures)
+            continue
+
+        # --- Verify ---
+        problem = None
+        if total is not None and offset != total:
+            problem = f"size {offset} != {total}"
+        elif expected_sha and digest.hexdigest() != expected_sha.lower():
+            problem = "SHA-256 mismatch"
+        if problem is None:
+            break
+
+        os.remove(part)
+        failures += 1
+        if failures > max_resumes:
+            raise DownloadError(f"Download of {path} is corrupt: {problem}")
+        print(f"[{service}] {path}: {problem}, downloading again")
+        offset, digest = 0, hashlib.sha256()
+
+    os.replace(part, dest)
+    print(f"[{service}] {path}: {offset} bytes → {dest}")
+    return dest
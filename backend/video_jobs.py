@@ -0,0 +1,132 @@
+# video_jobs.py
+"""
+Background job subsystem for video generation.
+
+``create_chat`` submits a job and returns immediately; a bounded pool of
+asyncio workers runs the (slow) video helpers and records every stage in
+Mongo, so clients can poll ``GET /api/jobs/{id}`` and unfinished jobs are
+picked up again when the backend restarts.
+"""
+import asyncio
+import os
+from datetime import datetime
+from typing import Awaitable, Callable
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+# Job lifecycle
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+ERROR = "error"
+
+MAX_WORKERS = int(os.environ.get("VIDEO_JOB_WORKERS", "2"))
+
+# handler(job_doc, progress) -> html snippet stored on the chat
+JobHandler = Callable[[dict, Callable[..., Awaitable[None]]], Awaitable[str]]
+
+
+class VideoJobManager:
+    def __init__(self, collection, handlers: dict[str, JobHandler], workers: int = MAX_WORKERS):
+        self.collection = collection
+        self.handlers = handlers
+        self.workers = workers
+        self._queue: asyncio.Queue[ObjectId] = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+
+    # --- Lifecycle ---
+    async def start(self):
+        await self.collection.create_index([("status", 1), ("createdAt", 1)])
+        await self.collection.create_index([("userId", 1), ("chatId", 1)])
+
+        # The backend runs as a single process, so anything still marked as
+        # running belongs to a worker that died with the previous process.
+        await self.collection.update_many({"status": RUNNING}, {"$set": {"status": QUEUED}})
+        async for job in self.collection.find({"status": QUEUED}, {"_id": 1}).sort("createdAt", 1):
+            self._queue.put_nowait(job["_id"])
+
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(i)))
+        print(f"🎬 Video job workers started ({self.workers}), {self._queue.qsize()} job(s) resumed")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    # --- Public API ---
+    async def submit(self, kind: str, payload: dict, chat_id: str, user_id: str) -> str:
+        if kind not in self.handlers:
+            raise KeyError(f"Unknown video job type: {kind}")
+        now = datetime.utcnow()
+        job = {
+            "kind": kind,
+            "chatId": chat_id,
+            "userId": user_id,
+            "payload": payload,
+            "status": QUEUED,
+            "stage": QUEUED,
+            "stages": [{"stage": QUEUED, "at": now}],
+            "createdAt": now,
+            "updatedAt": now,
+        }
+        result = await self.collection.insert_one(job)
+        self._queue.put_nowait(result.inserted_id)
+        return str(result.inserted_id)
+
+    async def get(self, job_id: str, user_id: str) -> dict | None:
+        job = await self.collection.find_one(
+            {"_id": ObjectId(job_id), "userId": user_id},
+            {"payload": 0},
+        )
+        if job:
+            job["_id"] = str(job["_id"])
+        return job
+
+    # --- Internals ---
+    async def _set_stage(self, job_id: ObjectId, stage: str, **fields):
+        now = datetime.utcnow()
+        await self.collection.update_one(
+            {"_id": job_id},
+            {
+                "$set": {"stage": stage, "updatedAt": now, **fields},
+                "$push": {"stages": {"stage": stage, "at": now}},
+            },
+        )
+
+    async def _worker(self, index: int):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Video worker {index} crashed on job {job_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: ObjectId):
+        # Claim the job atomically so a resumed job is never run twice
+        job = await self.collection.find_one_and_update(
+            {"_id": job_id, "status": QUEUED},
+            {"$set": {"status": RUNNING, "startedAt": datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if not job:
+            return
+
+        async def progress(stage: str, **fields):
+            # Fields are stored under the job so a restart can resume from them
+            await self._set_stage(job_id, stage, **{f"state.{k}": v for k, v in fields.items()})
+            job.setdefault("state", {}).update(fields)
+
+        try:
+            html = await self.handlers[job["kind"]](job, progress)
+            await self._set_stage(job_id, DONE, status=DONE, result=html)
+        except Exception as e:
+            detail = getattr(e, "detail", None) or str(e)
+            print(f"❌ Video job {job_id} failed: {detail}")
+            await self._set_stage(job_id, ERROR, status=ERROR, error=detail)
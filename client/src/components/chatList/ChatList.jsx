@@ -1,18 +1,21 @@
 import { Link } from "react-router-dom";
 import "./chatList.css";
-import { useQuery } from "@tanstack/react-query";
+import { useInfiniteQuery } from "@tanstack/react-query";
 import { useAuth } from "@clerk/clerk-react";
 
 const ChatList = ({ selectedType }) => {
   const { getToken } = useAuth();
 
-  const { isPending, error, data } = useQuery({
+  const { isPending, error, data, fetchNextPage, hasNextPage, isFetchingNextPage } = useInfiniteQuery({
     queryKey: ["userChats", selectedType],
-    queryFn: async () => {
+    queryFn: async ({ pageParam }) => {
       const token = await getToken();
-      const url = `${import.meta.env.VITE_API_URL}/api/userchats?type=${encodeURIComponent(
+      let url = `${import.meta.env.VITE_API_URL}/api/userchats?type=${encodeURIComponent(
         selectedType
       )}`;
+      if (pageParam) {
+        url += `&cursor=${encodeURIComponent(pageParam)}`;
+      }
 
       const res = await fetch(url, {
         headers: {
@@ -25,12 +28,17 @@ const ChatList = ({ selectedType }) => {
         throw new Error(message || "Failed to fetch user chats");
       }
 
-      return res.json();
+      // Chats come newest first; the server sends the next page's cursor as a header
+      return { chats: await res.json(), nextCursor: res.headers.get("X-Next-Cursor") };
     },
+    initialPageParam: null,
+    getNextPageParam: (lastPage) => lastPage.nextCursor || undefined,
     enabled: !!selectedType,
     staleTime: 10000,
   });
 
+  const chats = data ? data.pages.flatMap((page) => page.chats) : [];
+
   return (
     <div className="chatList">
       <span className="title">DASHBOARD</span>
@@ -43,14 +51,23 @@ const ChatList = ({ selectedType }) => {
           "Loading..."
         ) : error ? (
           <span style={{ color: "red" }}>Something went wrong!</span>
-        ) : Array.isArray(data) && data.length > 0 ? (
-          [...data]
-            .reverse()
-            .map((chat) => (
+        ) : chats.length > 0 ? (
+          <>
+            {chats.map((chat) => (
               <Link to={`/dashboard/chats/${chat._id}`} key={chat._id}>
                 {chat.title || "Untitled Chat"}
               </Link>
-            ))
+            ))}
+            {hasNextPage && (
+              <button
+                className="loadMore"
+                onClick={() => fetchNextPage()}
+                disabled={isFetchingNextPage}
+              >
+                {isFetchingNextPage ? "Loading..." : "Load more"}
+              </button>
+            )}
+          </>
         ) : (
           <span style={{ color: "#999" }}>No chats found.</span>
         )}
@@ -5,6 +5,30 @@ import Markdown from "react-markdown";
 import { useMutation, useQueryClient } from "@tanstack/react-query";
 import { useAuth } from "@clerk/clerk-react";
 
+// Reads a text/event-stream response and calls onEvent(event, data) per message
+const readEventStream = async (res, onEvent) => {
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let boundary;
+    while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+      const raw = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      let event = "message";
+      const dataLines = [];
+      for (const line of raw.split("\n")) {
+        if (line.startsWith("event:")) event = line.slice(6).trim();
+        else if (line.startsWith("data:")) dataLines.push(line.slice(5).trim());
+      }
+      if (dataLines.length) onEvent(event, JSON.parse(dataLines.join("\n")));
+    }
+  }
+};
+
 const NewPrompt = ({ data }) => {
   const [question, setQuestion] = useState("");
   const [answer, setAnswer]     = useState("");
@@ -21,7 +45,7 @@ const NewPrompt = ({ data }) => {
     "Video Generation (Fluid)",
   ];
   const isSingleTurn    = singleTurnTypes.includes(data?.type);
-  const alreadyAnswered = data?.history?.length > 1;
+  const alreadyAnswered = data?.messageCount > 1;
 
   // auto-scroll to bottom
   useEffect(() => {
@@ -33,7 +57,7 @@ const NewPrompt = ({ data }) => {
     mutationFn: async () => {
       const token = await getToken();
       const res = await fetch(
-        `${import.meta.env.VITE_API_URL}/api/chats/${data._id}/message`,
+        `${import.meta.env.VITE_API_URL}/api/chats/${data._id}/message?stream=true`,
         {
           method: "POST",
           headers: {
@@ -44,8 +68,19 @@ const NewPrompt = ({ data }) => {
         }
       );
       if (!res.ok) throw new Error(await res.text());
-      const { answer } = await res.json();
-      return answer;
+
+      // Show tokens as they arrive; the server persists the full answer at the end
+      let streamed = "";
+      setAnswer("");
+      await readEventStream(res, (event, payload) => {
+        if (event === "chunk") {
+          streamed += payload;
+          setAnswer(streamed);
+        } else if (event === "error") {
+          throw new Error(payload);
+        }
+      });
+      return streamed;
     },
     onSuccess: async (fullText) => {
       setAnswer(fullText);
@@ -100,6 +135,13 @@ const NewPrompt = ({ data }) => {
         {/* immediately render user's question */}
         {question && <div className="message user">{question}</div>}
 
+        {/* answer streams in until the refreshed history takes over */}
+        {mutation.isPending && answer && (
+          <div className="message">
+            <Markdown>{answer}</Markdown>
+          </div>
+        )}
+
         {/* buffer */}
         <div className="endChat" ref={endRef} />
 
@@ -1,20 +1,34 @@
 import "./chatPage.css";
 import NewPrompt from "../../components/newPrompt/NewPrompt";
-import { useQuery } from "@tanstack/react-query";
+import { useInfiniteQuery } from "@tanstack/react-query";
 import { useLocation } from "react-router-dom";
 import Markdown from "react-markdown";
 import { useAuth } from "@clerk/clerk-react";
 
+// Messages fetched per page; older ones are loaded on demand
+const HISTORY_PAGE_SIZE = 50;
+
 const ChatPage = () => {
   const path = useLocation().pathname;
   const chatId = path.split("/").pop();
   const { getToken } = useAuth();
 
-  const { isPending, error, data } = useQuery({
+  const {
+    isPending,
+    error,
+    data: pagesData,
+    fetchNextPage,
+    hasNextPage,
+    isFetchingNextPage,
+  } = useInfiniteQuery({
     queryKey: ["chat", chatId],
-    queryFn: async () => {
+    queryFn: async ({ pageParam }) => {
       const token = await getToken();
-      const res = await fetch(`${import.meta.env.VITE_API_URL}/api/chats/${chatId}`, {
+      let url = `${import.meta.env.VITE_API_URL}/api/chats/${chatId}?limit=${HISTORY_PAGE_SIZE}`;
+      if (pageParam !== null) {
+        url += `&before=${pageParam}`;
+      }
+      const res = await fetch(url, {
         headers: {
           Authorization: `Bearer ${token}`,
         },
@@ -27,8 +41,23 @@ const ChatPage = () => {
 
       return res.json();
     },
+    // Pages go from newest to oldest; each one starts where the previous one began
+    initialPageParam: null,
+    getNextPageParam: (lastPage) => (lastPage.historyStart > 0 ? lastPage.historyStart : undefined),
+    // Video chats get their reply from a background job: keep polling until it lands
+    refetchInterval: (query) => {
+      const chat = query.state.data?.pages[0];
+      return chat?.type?.startsWith("Video Generation") && chat.messageCount <= 1
+        ? 5000
+        : false;
+    },
   });
 
+  const data = pagesData && {
+    ...pagesData.pages[0],
+    history: [...pagesData.pages].reverse().flatMap((page) => page.history),
+  };
+
   return (
     <div className="chatPage">
       <div className="wrapper">
@@ -38,18 +67,29 @@ const ChatPage = () => {
           ) : error ? (
             <span style={{ color: "red" }}>Something went wrong!</span>
           ) : Array.isArray(data?.history) && data.history.length > 0 ? (
-            data.history.map((message, i) => (
-              <div
-                key={i}
-                className={message.role === "user" ? "message user" : "message"}
-              >
-                {message.parts[0].text.includes("<video") ? (
-                  <div dangerouslySetInnerHTML={{ __html: message.parts[0].text }} />
-                ) : (
-                  <Markdown>{message.parts[0].text}</Markdown>
-                )}
-              </div>
-            ))
+            <>
+              {hasNextPage && (
+                <button
+                  className="loadEarlier"
+                  onClick={() => fetchNextPage()}
+                  disabled={isFetchingNextPage}
+                >
+                  {isFetchingNextPage ? "Loading..." : "Load earlier messages"}
+                </button>
+              )}
+              {data.history.map((message, i) => (
+                <div
+                  key={i}
+                  className={message.role === "user" ? "message user" : "message"}
+                >
+                  {message.parts[0].text.includes("<video") ? (
+                    <div dangerouslySetInnerHTML={{ __html: message.parts[0].text }} />
+                  ) : (
+                    <Markdown>{message.parts[0].text}</Markdown>
+                  )}
+                </div>
+              ))}
+            </>
           ) : (
             <span style={{ color: "#aaa" }}>No messages yet. Start the conversation below.</span>
           )}
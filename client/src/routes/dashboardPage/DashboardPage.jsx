@@ -50,7 +50,9 @@ const DashboardPage = () => {
       if (!res.ok) throw new Error(await res.text());
       return res.json();
     },
-    onSuccess: async (chatId) => {
+    onSuccess: async (result) => {
+      // Video chats answer 202 with { chatId, jobId } while the job runs in the background
+      const chatId = typeof result === "string" ? result : result.chatId;
       await queryClient.invalidateQueries({ queryKey: ["userChats", selectedType] });
       setIsLoading(false); // <-- stop loading
       navigate(`/dashboard/chats/${chatId}`);